@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Benchmark for the extraction of the WebID credentials from a
+(parsed) profile: SPARQL query vs. direct triples() walk.
+
+usage: python scripts/bench_extract.py [knows] [keys] [runs]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import rdflib
+
+from webid import fetcher  # registers the sparql plugins
+from webid.extractors import extract_credentials_sparql, \
+        extract_credentials_triples
+
+PROFILE_HEAD = """@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix cert: <http://www.w3.org/ns/auth/cert#> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+<#me> a foaf:Person ;
+    foaf:name "Bench Mark" ;
+    foaf:nick "bench" .
+"""
+
+KNOWS = """<#me> foaf:knows <http://example.org/people/%(i)s#me> .
+<http://example.org/people/%(i)s#me> a foaf:Person ;
+    foaf:name "Friend %(i)s" .
+"""
+
+KEY = """<#me> cert:key [
+    cert:modulus "%(mod)s"^^xsd:hexBinary ;
+    cert:exponent 65537 ] .
+"""
+
+
+def make_profile(knows, keys):
+    parts = [PROFILE_HEAD]
+    for i in range(knows):
+        parts.append(KNOWS % {'i': i})
+    for i in range(keys):
+        parts.append(KEY % {'mod': "%0512x" % (0xc0ffee + i)})
+    return ''.join(parts)
+
+
+def main(knows=200, keys=3, runs=200):
+    graph = rdflib.ConjunctiveGraph()
+    graph.parse(data=make_profile(knows, keys), format="n3",
+            publicID="http://example.org/bench/card")
+    print "profile: %s triples, %s keys" % (len(graph), keys)
+
+    assert extract_credentials_sparql(graph) == \
+            extract_credentials_triples(graph)
+
+    for name, func in (("sparql", extract_credentials_sparql),
+                       ("triples", extract_credentials_triples)):
+        best = min(timeit.repeat(lambda: func(graph),
+            repeat=3, number=runs))
+        print "%-8s %8.3f ms per profile" % (name, best * 1000.0 / runs)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Benchmark of the cost of parsing the same WebID profile in each
+of the formats the WebIDLoader understands.
+(RDFa is left out: rdflib cannot serialize it.)
+
+usage: python scripts/bench_formats.py [knows] [keys] [runs]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import rdflib
+
+from webid.fetcher import PARSER_FORMATS, HAS_JSONLD
+from bench_extract import make_profile
+
+BASE = "http://example.org/bench/card"
+
+# content type -> rdflib serializer
+SERIALIZERS = (
+    ('application/n-triples', 'nt'),
+    ('text/turtle', 'turtle'),
+    ('application/rdf+xml', 'xml'),
+    ('application/ld+json', 'json-ld'),
+)
+
+
+def main(knows=200, keys=3, runs=50):
+    graph = rdflib.ConjunctiveGraph()
+    graph.parse(data=make_profile(knows, keys), format="n3",
+            publicID=BASE)
+    print "profile: %s triples, %s keys" % (len(graph), keys)
+
+    for ctype, serializer in SERIALIZERS:
+        if serializer == 'json-ld' and not HAS_JSONLD:
+            print "%-22s (rdflib-jsonld not installed)" % ctype
+            continue
+        data = graph.serialize(format=serializer)
+        parser = PARSER_FORMATS[ctype]
+
+        def parse():
+            g = rdflib.ConjunctiveGraph()
+            g.parse(data=data, format=parser, publicID=BASE)
+
+        best = min(timeit.repeat(parse, repeat=3, number=runs))
+        print "%-22s %7s bytes %8.3f ms per parse" % (
+                ctype, len(data), best * 1000.0 / runs)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
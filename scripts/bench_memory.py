@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Memory benchmark for the result and claim records.
+
+With no arguments, builds the TestResults and WebIDClaims of an
+exhaustive validation of a profile with many keys, and compares
+them with the old dict-backed layout.
+Given a PEM cert, measures a whole (exhaustive) validation of it.
+
+Uses tracemalloc when it's there (python >= 3.4, or pytracemalloc
+on a patched python 2.7); otherwise falls back to adding up the
+sys.getsizeof of the records (and of their dicts).
+
+usage: python scripts/bench_memory.py [keys] [uris]
+       python scripts/bench_memory.py cert.pem
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from webid.serializers import Id, PublicKey, WebIDClaim
+from webid.validator import TestResult, WebIDValidator
+
+# checks run per pubkey, and per uri (besides the pubkey ones)
+PUBKEY_CHECKS = 7
+URI_CHECKS = 6
+
+
+class DictResult(Id):
+    """
+    the dict-backed TestResult we had before.
+    """
+    def __init__(self, *args, **kwargs):
+        self.passed = kwargs.get('passed', False)
+        self.pointer = None
+        self.subject = None
+        self.details = None
+        self.uri = kwargs.get('uri', None)
+        self.pubkey = kwargs.get('pubkey', None)
+
+
+class DictClaim(Id):
+    """
+    the dict-backed WebIDClaim we had before.
+    """
+    def __init__(self, claimedURI, pk, *args, **kwargs):
+        self.claimedURI = claimedURI
+        self.pubkey = pk
+
+
+def make_records(result_cls, claim_cls, keys, uris):
+    records = []
+    for u in range(uris):
+        uri = "http://example.org/people/%s#me" % u
+        pubkeys = [PublicKey("%0512x" % (0xc0ffee + k), 65537)
+                for k in range(keys)]
+        for i in range(URI_CHECKS):
+            records.append(result_cls(passed=True, uri=uri))
+        for pubkey in pubkeys:
+            records.append(claim_cls(uri, pubkey))
+            for i in range(PUBKEY_CHECKS):
+                records.append(result_cls(passed=True, uri=uri,
+                    pubkey=pubkey))
+    return records
+
+
+def getsizeof_records(records):
+    size = 0
+    for record in records:
+        size += sys.getsizeof(record)
+        if hasattr(record, '__dict__'):
+            size += sys.getsizeof(record.__dict__)
+    return size
+
+
+def measure(func, *args):
+    """
+    returns (result, bytes allocated by func that are still alive).
+    """
+    if tracemalloc is None:
+        result = func(*args)
+        return result, None
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = func(*args)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in
+            after.compare_to(before, 'filename'))
+    return result, size
+
+
+def bench_records(keys=30, uris=2):
+    print "%s uris, %s keys per profile (%s)" % (uris, keys,
+            "tracemalloc" if tracemalloc else "sys.getsizeof")
+    for name, result_cls, claim_cls in (
+            ("dict", DictResult, DictClaim),
+            ("slots", TestResult, WebIDClaim)):
+        records, size = measure(make_records, result_cls, claim_cls,
+                keys, uris)
+        if size is None:
+            size = getsizeof_records(records)
+        print "%-6s %6d records %10d bytes %8.1f bytes per record" % (
+                name, len(records), size, float(size) / len(records))
+
+
+def bench_validation(path):
+    certstr = open(path).read()
+
+    def _validate():
+        validator = WebIDValidator(certstr=certstr, mode='exhaustive')
+        validator.validate()
+        return validator
+
+    validator, size = measure(_validate)
+    print "validated: %s" % validator.validatedURI
+    if size is None:
+        print "tracemalloc is not available"
+    else:
+        print "%d bytes alive after the validation" % size
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+        bench_validation(sys.argv[1])
+    else:
+        bench_records(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,376 @@
+import hashlib
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urldefrag
+
+"""
+In-memory caches used by the fetcher and the validator.
+They are thread-safe, so a single instance can be shared
+by all the validators in a (threaded) server process.
+"""
+
+# link fields
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES = range(6)
+
+
+class LRUCache(object):
+    """
+    A LRU cache bounded by number of entries (maxsize) and,
+    optionally, by the sum of the sizes given on set (maxbytes).
+    Entries can have a time to live, either the default one
+    given on init or one given on set.
+    """
+    def __init__(self, maxsize=128, maxbytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._data = dict()
+        # circular doubly linked list; root[NEXT] is the
+        # least recently used entry, root[PREV] the most recent.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0, None]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        link = self._data.get(key, None)
+        return link is not None and (link[EXPIRES] is None or
+                link[EXPIRES] > time.time())
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        del self._data[link[KEY]]
+        self.bytes -= link[SIZE]
+
+    def get(self, key, default=None, touch=True):
+        """
+        returns the value for key, or default if it's not there
+        (or has expired). touch=False does not update the LRU order.
+        """
+        self._lock.acquire()
+        try:
+            link = self._data.get(key, None)
+            if link is None:
+                self.misses += 1
+                return default
+            if link[EXPIRES] is not None and link[EXPIRES] <= time.time():
+                self._unlink(link)
+                self.misses += 1
+                return default
+            if touch:
+                link[PREV][NEXT] = link[NEXT]
+                link[NEXT][PREV] = link[PREV]
+                root = self._root
+                last = root[PREV]
+                last[NEXT] = root[PREV] = link
+                link[PREV], link[NEXT] = last, root
+            self.hits += 1
+            return link[VALUE]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, size=0, ttl=None):
+        """
+        stores value for key, as the most recently used entry,
+        and evicts the least recently used ones if over limits.
+        values bigger than maxbytes are not stored.
+        """
+        if self.maxbytes is not None and size > self.maxbytes:
+            self.invalidate(key)
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        self._lock.acquire()
+        try:
+            link = self._data.get(key, None)
+            if link is not None:
+                self._unlink(link)
+            root = self._root
+            last = root[PREV]
+            link = [last, root, key, value, size, expires]
+            last[NEXT] = root[PREV] = self._data[key] = link
+            self.bytes += size
+            while self._data and (len(self._data) > self.maxsize or
+                    (self.maxbytes is not None and
+                     self.bytes > self.maxbytes)):
+                self._unlink(root[NEXT])
+        finally:
+            self._lock.release()
+
+    def invalidate(self, key):
+        """
+        removes key from the cache. returns True if it was there.
+        """
+        self._lock.acquire()
+        try:
+            link = self._data.get(key, None)
+            if link is None:
+                return False
+            self._unlink(link)
+            return True
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None, 0, None]
+            self.bytes = 0
+        finally:
+            self._lock.release()
+
+
+#
+# profile cache
+#
+
+def _parse_http_date(value):
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+
+def parse_cache_control(headers):
+    """
+    returns a dict with the Cache-Control directives of a response.
+    """
+    directives = dict()
+    for directive in (headers.get('cache-control', None) or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip().strip('"')
+    return directives
+
+
+def freshness_lifetime(headers):
+    """
+    returns the number of seconds a response is fresh for,
+    according to its Cache-Control / Expires headers; 0 if it has
+    to be revalidated; None if it must not be stored at all.
+    """
+    cc = parse_cache_control(headers)
+    if 'no-store' in cc:
+        return None
+    if 'no-cache' in cc:
+        return 0
+    try:
+        age = int(headers.get('age', None) or 0)
+    except ValueError:
+        age = 0
+    if 'max-age' in cc:
+        try:
+            return max(int(cc['max-age']) - age, 0)
+        except ValueError:
+            return 0
+    expires = _parse_http_date(headers.get('expires', None))
+    if expires is not None:
+        date = _parse_http_date(headers.get('date', None)) or time.time()
+        return max(int(expires - date) - age, 0)
+    return 0
+
+
+class CachedProfile(object):
+    """
+    A dereferenced profile, as stored in the ProfileCache.
+    Besides the content and the validators for conditional GETs,
+    keeps the credentials that were extracted from it, so they can
+    be reused without parsing the profile again.
+    """
+    def __init__(self, uri, content, ctype, headers, status_code,
+            credentials=None):
+        self.uri = uri
+        self.content = content
+        self.ctype = ctype
+        self.headers = headers
+        self.status_code = status_code
+        self.credentials = credentials
+        self.content_hash = hashlib.sha1(content).hexdigest()
+        self.etag = headers.get('etag', None)
+        self.last_modified = headers.get('last-modified', None)
+        self.refresh(headers)
+
+    def refresh(self, headers):
+        """
+        recomputes the expiration time from the headers of a
+        (200 or 304) response.
+        """
+        lifetime = freshness_lifetime(headers) or 0
+        self.expires = time.time() + lifetime
+
+    @property
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    @property
+    def can_revalidate(self):
+        return bool(self.etag or self.last_modified)
+
+    def conditional_headers(self):
+        """
+        returns the headers for revalidating this entry.
+        """
+        headers = dict()
+        if self.etag:
+            headers['if-none-match'] = self.etag
+        if self.last_modified:
+            headers['if-modified-since'] = self.last_modified
+        return headers
+
+
+class ProfileCache(LRUCache):
+    """
+    LRU cache of dereferenced WebID profiles, keyed by the URI
+    without its fragment. It honours Cache-Control and Expires, and
+    is bounded both by number of entries and by content size.
+    """
+    def __init__(self, maxsize=1000, maxbytes=16 * 1024 * 1024):
+        super(ProfileCache, self).__init__(maxsize=maxsize,
+                maxbytes=maxbytes)
+
+    def key(self, uri):
+        return urldefrag(uri)[0]
+
+    def lookup(self, uri):
+        return self.get(self.key(uri), None)
+
+    def store(self, uri, content, ctype, headers, status_code,
+            credentials=None):
+        """
+        stores a response, unless it says it must not be stored.
+        returns the CachedProfile (or None).
+        """
+        if freshness_lifetime(headers) is None:
+            self.invalidate(uri)
+            return None
+        headers = dict((k.lower(), v) for k, v in headers.items())
+        entry = CachedProfile(self.key(uri), content, ctype,
+                headers, status_code, credentials=credentials)
+        self.set(entry.uri, entry, size=len(content))
+        return entry
+
+    def update(self, entry):
+        """
+        re-stores an entry (i.e., after a 304), marking it as
+        the most recently used one.
+        """
+        self.set(entry.uri, entry, size=len(entry.content))
+
+    def invalidate(self, uri):
+        return super(ProfileCache, self).invalidate(self.key(uri))
+
+
+class NegativeCache(LRUCache):
+    """
+    Short-lived cache of failed profile dereferences, keyed by the
+    URI without its fragment. The value is the reason of the failure.
+    """
+    def __init__(self, maxsize=1000, ttl=30):
+        super(NegativeCache, self).__init__(maxsize=maxsize, ttl=ttl)
+
+    def key(self, uri):
+        return urldefrag(uri)[0]
+
+    def lookup(self, uri):
+        return self.get(self.key(uri), None)
+
+    def store(self, uri, reason, ttl=None):
+        self.set(self.key(uri), reason, ttl=ttl)
+
+    def invalidate(self, uri):
+        return super(NegativeCache, self).invalidate(self.key(uri))
+
+
+#
+# validation results cache
+#
+
+class ValidationCache(LRUCache):
+    """
+    Cache of validation outcomes, keyed by the SHA-256 fingerprint
+    of the cert DER (see cert.get_fingerprint). The value is a
+    (validated, validatedURI) tuple. Successful validations are kept
+    for ttl seconds (never past the expiration of the cert); failed
+    ones are only kept if a negative_ttl is given.
+    Entries can be invalidated by fingerprint, or by URI, i.e., when
+    the profile of a WebID has changed.
+    """
+    def __init__(self, maxsize=1000, ttl=300, negative_ttl=None):
+        super(ValidationCache, self).__init__(maxsize=maxsize, ttl=ttl)
+        self.negative_ttl = negative_ttl
+        # uri -> set of fingerprints validated with it
+        self._by_uri = dict()
+
+    def _unlink(self, link):
+        super(ValidationCache, self)._unlink(link)
+        uri = link[VALUE][1]
+        fingerprints = self._by_uri.get(uri, None)
+        if fingerprints is not None:
+            fingerprints.discard(link[KEY])
+            if not fingerprints:
+                del self._by_uri[uri]
+
+    def lookup(self, fingerprint):
+        """
+        returns the cached (validated, validatedURI) tuple, or None.
+        """
+        if fingerprint is None:
+            return None
+        return self.get(fingerprint, None)
+
+    def store(self, fingerprint, validated, uri=None, ttl=None):
+        """
+        stores the outcome of a validation. ttl, if given, caps
+        the default one (i.e., the seconds left for the cert).
+        """
+        if fingerprint is None:
+            return
+        default = self.ttl if validated else self.negative_ttl
+        if default is None:
+            return
+        if ttl is not None:
+            default = min(default, ttl)
+        if default <= 0:
+            self.invalidate(fingerprint)
+            return
+        self._lock.acquire()
+        try:
+            self.set(fingerprint, (bool(validated), uri), ttl=default)
+            self._by_uri.setdefault(uri, set()).add(fingerprint)
+        finally:
+            self._lock.release()
+
+    def invalidate_uri(self, uri):
+        """
+        removes all the outcomes for a given URI.
+        returns how many there were.
+        """
+        self._lock.acquire()
+        try:
+            fingerprints = list(self._by_uri.get(uri, ()))
+            for fingerprint in fingerprints:
+                self.invalidate(fingerprint)
+            return len(fingerprints)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            super(ValidationCache, self).clear()
+            self._by_uri.clear()
+        finally:
+            self._lock.release()
@@ -1,61 +1,235 @@
+import base64
+import binascii
 from datetime import datetime
+import hashlib
 import logging
+import re
+import urllib
 
 import M2Crypto
 
-from serializers import Id, PublicKey
+try:
+    from collections import namedtuple
+except ImportError:
+    # python2.5 backport
+    from xcollections import namedtuple
+
+from cache import LRUCache
+from serializers import Id, PublicKey, normalize_modulus
 
 logger = logging.getLogger()
 
 #XXX get this from settings
 RAISE_CERT_EXCEPTIONS=False
 
+PEM_RE = re.compile(r'-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----',
+        re.S)
+
+
+def pem_to_der(certstr):
+    """
+    returns the DER bytes of a PEM cert (the first one, if there
+    are several), or None if it cannot be decoded.
+    """
+    match = PEM_RE.search(certstr)
+    if match is None:
+        return None
+    try:
+        return base64.b64decode(''.join(match.group(1).split()))
+    except (TypeError, binascii.Error):
+        return None
+
+
+# where web servers and TLS terminators put the client cert
+# (in a WSGI environ).
+CERT_ENVIRON_KEYS = ('SSL_CLIENT_CERT', 'HTTP_X_SSL_CLIENT_CERT')
+NO_CERT_VALUES = ('', '(null)')
+
+
+def header_to_der(value):
+    """
+    returns the DER bytes of a cert as passed by a web server or a
+    TLS terminator: a PEM (apache SSL_CLIENT_CERT), maybe URL-escaped
+    (nginx $ssl_client_escaped_cert) or with its newlines turned into
+    spaces or tabs, or just the base64 of the DER.
+    None if it cannot be decoded.
+    """
+    if '%' in value:
+        value = urllib.unquote(value)
+    if '-----BEGIN' in value:
+        return pem_to_der(value)
+    try:
+        return base64.b64decode(''.join(value.split()))
+    except (TypeError, binascii.Error):
+        return None
+
+
+def get_fingerprint(certstr):
+    """
+    returns the SHA-256 fingerprint (hex) of the DER of a PEM cert,
+    without loading it with M2Crypto. None if it cannot be decoded.
+    """
+    der = pem_to_der(certstr)
+    if der is None:
+        return None
+    return hashlib.sha256(der).hexdigest()
+
+
+# what we need to know about a cert, decoded once.
+CertInfo = namedtuple('CertInfo', ['mod', 'exp', 'subjectAltName',
+        'not_before', 'not_after', 'critical_extensions'])
+
+# decoded certs (CertInfo) by fingerprint, shared by all the
+# validators in the process, so a returning cert is not
+# loaded with M2Crypto again.
+CERT_CACHE_SIZE = 1000
+_cert_cache = LRUCache(maxsize=CERT_CACHE_SIZE)
+
+
+def decode_cert(x509):
+    """
+    returns a CertInfo with the facts of a M2Crypto x509 cert.
+    """
+    try:
+        pubkey = x509.get_pubkey()
+        mod = normalize_modulus(pubkey.get_modulus())
+        # the exponent comes as a MPI: 4 bytes of length and
+        # then the big-endian bytes of the number.
+        _exp = M2Crypto.m2.rsa_get_e(pubkey.get_rsa().rsa)
+        exp = int(binascii.hexlify(_exp[4:]) or '0', 16)
+    except (ValueError, M2Crypto.EVP.EVPError, M2Crypto.RSA.RSAError):
+        # not a RSA key
+        mod, exp = None, None
+    try:
+        altName = x509.get_ext('subjectAltName').get_value()
+    except:
+        if RAISE_CERT_EXCEPTIONS:
+            raise
+        altName = None
+    critical = []
+    for i in range(x509.get_ext_count()):
+        ext = x509.get_ext_at(i)
+        if ext.get_critical() == 1:
+            critical.append(ext.get_name())
+    return CertInfo(mod, exp, altName,
+            x509.get_not_before().get_datetime(),
+            x509.get_not_after().get_datetime(),
+            tuple(critical))
+
 
 class Cert(Id):
     """
     Class for representing a x509 cert.
     Has validation methods.
+    It's built from a PEM string, or from the DER bytes (see also
+    the from_* constructors). The cert is only loaded with M2Crypto
+    (see x509) the first time its facts are needed; they are then
+    kept in a process-wide LRU cache, by fingerprint.
     """
-    def __init__(self, certstr, *args, **kwargs):
-        try:
-            self.x509 = M2Crypto.X509.load_cert_string(certstr)
-            #XXX get a better regexp for this
-            self.b64der = certstr.replace(
-                        '-----BEGIN CERTIFICATE-----', '').\
-                        replace(
-                        '-----END CERTIFICATE-----', '').\
-                        replace('\n', '')
-        except:
-            self.x509 = None
+    def __init__(self, certstr=None, der=None, *args, **kwargs):
+        if der is None and certstr:
+            der = pem_to_der(certstr)
+        self.der = der
+        self._b64der = None
+        self.fingerprint = None
+        if self.der is not None:
+            self.fingerprint = hashlib.sha256(self.der).hexdigest()
+        # not loaded yet
+        self._x509 = False
+        self._info = None
         self.pubkey = PublicKey(None, None)
         self.subjectAltName = None
         super(Cert, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def from_der(cls, der):
+        return cls(der=der)
+
+    @classmethod
+    def from_pem(cls, buf):
+        """
+        buf can be a string or any buffer (i.e., a bytearray).
+        """
+        if not isinstance(buf, basestring):
+            buf = str(buf)
+        return cls(der=pem_to_der(buf))
+
+    @classmethod
+    def from_header(cls, value):
+        """
+        returns a Cert from the value of a SSL_CLIENT_CERT variable
+        or X-SSL-Client-Cert header (see header_to_der), or None if
+        no cert was given.
+        """
+        if value is None or value.strip() in NO_CERT_VALUES:
+            return None
+        return cls(der=header_to_der(value))
+
+    @classmethod
+    def from_environ(cls, environ):
+        """
+        returns a Cert from a WSGI environ, or None if no cert
+        was given.
+        """
+        for key in CERT_ENVIRON_KEYS:
+            cert = cls.from_header(environ.get(key, None))
+            if cert is not None:
+                return cert
+        return None
+
+    @property
+    def b64der(self):
+        """
+        the base64 of the DER (the PEM without armor nor newlines).
+        """
+        if self._b64der is None and self.der is not None:
+            self._b64der = base64.b64encode(self.der)
+        return self._b64der
+
+    @property
+    def x509(self):
+        """
+        the M2Crypto x509 object, loaded on first access.
+        None if the cert could not be loaded.
+        """
+        if self._x509 is False:
+            self._x509 = None
+            if self.der is not None:
+                try:
+                    self._x509 = M2Crypto.X509.load_cert_der_string(self.der)
+                except:
+                    pass
+        return self._x509
+
+    @property
+    def info(self):
+        """
+        the decoded facts of the cert (a CertInfo), from the cache
+        if we have seen this cert before. None if it can't be loaded.
+        """
+        if self._info is None and self.fingerprint is not None:
+            self._info = _cert_cache.get(self.fingerprint)
+            if self._info is None and self.x509 is not None:
+                self._info = decode_cert(self.x509)
+                _cert_cache.set(self.fingerprint, self._info)
+        return self._info
+
     #
     # cert processing methods
     #
 
     def get_subjectAltName(self):
-        try:
-            altName = self.x509.get_ext('subjectAltName').get_value()
-            self.subjectAltName = altName
-            return altName
-        except:
-            if RAISE_CERT_EXCEPTIONS:
-                raise
-            else:
-                return None
+        if self.info is None:
+            return None
+        self.subjectAltName = self.info.subjectAltName
+        return self.subjectAltName
 
     def get_pubkey(self):
-        #XXX clean
-        if not self.x509:
+        if self.info is None or self.info.mod is None:
             return None
-        mm = str(self.x509.get_pubkey().get_modulus().lower())
-        _exp = M2Crypto.m2.rsa_get_e(self.x509.get_pubkey().get_rsa().rsa)
-        ee = int(''.join(["%2.2d" % ord(x) for x in _exp[-3:]]), 16)
-        self.pubkey = PublicKey(mod=mm, exp=ee)
-        logger.debug('cert. mod = %s' % mm)
-        logger.debug('cert. exp = %s' % ee)
+        self.pubkey = PublicKey(mod=self.info.mod, exp=self.info.exp)
+        logger.debug('cert. mod = %s' % self.info.mod)
+        logger.debug('cert. exp = %s' % self.info.exp)
 
     def get_exp(self):
         return self.pubkey.exp
@@ -70,29 +244,36 @@ class Cert(Id):
             self.get_mod() is not None) else False
 
     def check_date_Ok(self):
-        if not self.x509:
+        if self.info is None:
             return False
-        nb = self.x509.get_not_before().get_datetime()
-        na = self.x509.get_not_after().get_datetime()
+        nb, na = self.info.not_before, self.info.not_after
         tz = na.tzinfo
         now = datetime.now(tz)
         return True if ((now > nb) and (now < na)) else False
 
+    def seconds_to_expire(self):
+        """
+        returns the seconds left until the cert expires
+        (negative if it has already expired), or None.
+        """
+        if self.info is None:
+            return None
+        na = self.info.not_after
+        delta = na - datetime.now(na.tzinfo)
+        return delta.days * 86400 + delta.seconds
+
     def check_days_to_expire(self):
-        if not self.x509:
+        if self.info is None:
             return False
-        na = self.x509.get_not_after().get_datetime()
+        na = self.info.not_after
         tz = na.tzinfo
         now = datetime.now(tz)
         return (na - now).days
 
     def has_other_critical_extensions(self):
-        if not self.x509:
+        if self.info is None:
             return False
-        ext_count = self.x509.get_ext_count()
-        for i in range(ext_count):
-            ext = self.x509.get_ext_at(i)
-            crit, name = ext.get_critical(), ext.get_name()
-            if crit == 1 and name != "subjectAltName":
+        for name in self.info.critical_extensions:
+            if name != "subjectAltName":
                 return True
         return False
@@ -9,6 +9,18 @@ WHERE { [] cert:key [
 }
 """
 
+# same as above, but we also get the subject the key belongs to,
+# so we can extract the keys of all the WebIDs in a profile at once.
+WEBID_SPARQL_SUBJECTS = """
+PREFIX cert: <http://www.w3.org/ns/auth/cert#>
+SELECT ?webid ?mod ?exp
+WHERE { ?webid cert:key [
+        cert:modulus ?mod;
+        cert:exponent ?exp;
+        ] .
+}
+"""
+
 NAME_SPARQL = """
 PREFIX foaf: <http://xmlns.com/foaf/0.1/>
 PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -76,6 +88,8 @@ FORMATS = {
         'rdfa': 'application/xhtml+xml',
         'turtle': 'text/turtle',
         'n3': 'text/rdf+n3',
+        'nt': 'application/n-triples',
+        'jsonld': 'application/ld+json',
         #'html': 'text/html',
 }
 
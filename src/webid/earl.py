@@ -1,20 +1,24 @@
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import hashlib
 import logging
 import os
 import requests
 import StringIO
 
-import rdflib
-from rdflib import URIRef
-
 from constants import TESTREQS, TESTCASES
 
 WIT = "RelyingParty"
 WIT_FILENAME = "%s.n3" % WIT
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
-rdflib.plugin.register('sparql', rdflib.query.Processor,
-           'rdfextras.sparql.processor', 'Processor')
-rdflib.plugin.register('sparql', rdflib.query.Result,
-           'rdfextras.sparql.query', 'SPARQLQueryResult')
+# compiled spec, stored next to the n3 source.
+# it's invalidated when the hash of the source changes,
+# or when the layout below changes (bump the version).
+SPEC_CACHE_FILENAME = "%s.pickle" % WIT
+SPEC_CACHE_VERSION = 1
 
 # Namespaces declaration.
 # we're no longer using them. but we can need'em again :)
@@ -26,6 +30,31 @@ rdflib.plugin.register('sparql', rdflib.query.Result,
 logger = logging.getLogger()
 
 
+def _load_rdflib():
+    """
+    imports rdflib (and registers the sparql plugins) only
+    when we really have to parse the n3 source.
+    """
+    import rdflib
+    rdflib.plugin.register('sparql', rdflib.query.Processor,
+               'rdfextras.sparql.processor', 'Processor')
+    rdflib.plugin.register('sparql', rdflib.query.Result,
+               'rdfextras.sparql.query', 'SPARQLQueryResult')
+    return rdflib
+
+
+def get_spec_hash(path=None):
+    """
+    returns the sha1 hexdigest of the spec source file.
+    """
+    path = path or os.path.join(DATA_DIR, WIT_FILENAME)
+    _file = open(path, 'rb')
+    try:
+        return hashlib.sha1(_file.read()).hexdigest()
+    finally:
+        _file.close()
+
+
 class Parser(object):
     """
     This Class parses the Earl Vocabulary for WebID Relying Parties.
@@ -33,15 +62,72 @@ class Parser(object):
     WebIDValidator class. We take title, description, notes and dependencies
     from the vocabulary, for testCases and testRequirements.
     """
-    # XXX this has to be cached
-    # when used from django
-    # it's taking way too long in gettig init!!
+    # The parsed testcases and testreqs are compiled into
+    # data/RelyingParty.pickle the first time we parse the local
+    # n3 file, so later inits do not need rdflib at all.
 
     def __init__(self, *args, **kwargs):
-        self._get_webid_earl(download=kwargs.get('download', False))
+        download = kwargs.get('download', False)
+        if not download and self._load_compiled():
+            return
+        self._get_webid_earl(download=download)
         self._update_namespace()
         self._get_testcases()
         self._get_testreqs()
+        if not download:
+            self._save_compiled()
+
+    def _load_compiled(self, path=None):
+        """
+        loads testcases and testreqs from the compiled spec.
+        returns False if there is no compiled spec, or if it
+        is stale (source hash or layout version mismatch).
+        """
+        path = path or os.path.join(DATA_DIR, SPEC_CACHE_FILENAME)
+        try:
+            _file = open(path, 'rb')
+            try:
+                compiled = pickle.load(_file)
+            finally:
+                _file.close()
+        except Exception, e:
+            # missing or broken compiled spec; we just re-parse.
+            logger.debug('could not load compiled spec: %s' % e)
+            return False
+        if not isinstance(compiled, dict) or \
+                compiled.get('version') != SPEC_CACHE_VERSION or \
+                compiled.get('source_hash') != get_spec_hash():
+            logger.debug('compiled spec is stale')
+            return False
+        self.testcases = compiled['testcases']
+        self.testreqs = compiled['testreqs']
+        return True
+
+    def _save_compiled(self, path=None):
+        """
+        writes the compiled spec next to the n3 source.
+        failing to write (i.e., read-only site-packages)
+        is not an error, we just parse again next time.
+        """
+        path = path or os.path.join(DATA_DIR, SPEC_CACHE_FILENAME)
+        compiled = {'version': SPEC_CACHE_VERSION,
+                    'source_hash': get_spec_hash(),
+                    'testcases': self.testcases,
+                    'testreqs': self.testreqs}
+        tmppath = "%s.%s.tmp" % (path, os.getpid())
+        try:
+            _file = open(tmppath, 'wb')
+            try:
+                pickle.dump(compiled, _file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                _file.close()
+            os.rename(tmppath, path)
+        except (IOError, OSError), e:
+            logger.warning('could not write compiled spec: %s' % e)
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            return False
+        return True
 
     def parseURI(self, URI=None):
         """
@@ -60,18 +146,18 @@ class Parser(object):
             r = requests.get(URI)
             _file = StringIO.StringIO(r.content)
         else:
-            _file = open(os.path.join(
-                os.path.dirname(__file__), 'data', WIT_FILENAME))
+            _file = open(os.path.join(DATA_DIR, WIT_FILENAME))
             #XXX Get Timestamp fot the fetching.
             #we need to write verificationTimestamp
 
+        rdflib = _load_rdflib()
         self.g = rdflib.ConjunctiveGraph()
         self.g.parse(_file, format="n3")
 
     def _update_namespace(self):
         # updating the namespace
-        OLD = "file://" + os.path.join(
-                os.path.dirname(__file__), 'data', WIT_FILENAME)
+        from rdflib import URIRef
+        OLD = "file://" + os.path.join(DATA_DIR, WIT_FILENAME)
         NEW = "http://www.w3.org/2005/Incubator/webid/earl/%s#" % WIT
 
         for cid, _, source in self.g.triples((None, None, None)):
@@ -82,7 +168,7 @@ class Parser(object):
                         context.remove((s, p, o))
                         if isinstance(s, URIRef) and OLD in s:
                             s = URIRef(s.replace(OLD, NEW))
-                        if isinstance(s, rdflib.URIRef) and OLD in p:
+                        if isinstance(s, URIRef) and OLD in p:
                             p = URIRef(p.replace(OLD, NEW))
                         if isinstance(o, URIRef) and OLD in o:
                             o = URIRef(o.replace(OLD, NEW))
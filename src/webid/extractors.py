@@ -0,0 +1,334 @@
+import logging
+import re
+import xml.sax
+import xml.sax.handler
+from urlparse import urljoin
+
+from rdflib import URIRef
+
+from serializers import PublicKey
+from constants import WEBID_SPARQL_SUBJECTS
+
+"""
+Extraction of the WebID credentials (the cert:key blocks)
+from a profile.
+"""
+
+logger = logging.getLogger(name=__name__)
+
+CERT_NS = "http://www.w3.org/ns/auth/cert#"
+CERT_KEY = URIRef(CERT_NS + "key")
+CERT_MODULUS = URIRef(CERT_NS + "modulus")
+CERT_EXPONENT = URIRef(CERT_NS + "exponent")
+
+# default extraction method: "triples" walks the graph indexes
+# directly, "sparql" runs WEBID_SPARQL_SUBJECTS.
+EXTRACT_METHOD = "triples"
+
+
+def make_pubkey(mod, exp):
+    """
+    returns a PublicKey from the modulus and exponent literals
+    found in a profile.
+    """
+    # PublicKey normalizes the modulus
+    return PublicKey(mod=unicode(mod), exp=int(unicode(exp)))
+
+
+def _freeze(credentials):
+    return dict((webid, frozenset(keys))
+            for webid, keys in credentials.items())
+
+
+def extract_credentials_triples(graph):
+    """
+    returns a dict with the PublicKeys found in a profile graph,
+    as frozensets, by subject uri.
+    Walks webid cert:key ?key . ?key cert:modulus / cert:exponent
+    using the (indexed) triples() lookups of the graph.
+    """
+    credentials = dict()
+    for webid, _, key in graph.triples((None, CERT_KEY, None)):
+        for mod in graph.objects(key, CERT_MODULUS):
+            for exp in graph.objects(key, CERT_EXPONENT):
+                credentials.setdefault(unicode(webid), set()).add(
+                        make_pubkey(mod, exp))
+    return _freeze(credentials)
+
+
+def extract_credentials_sparql(graph):
+    """
+    same as extract_credentials_triples, but running a SPARQL query.
+    """
+    credentials = dict()
+    for webid, mod, exp in graph.query(WEBID_SPARQL_SUBJECTS):
+        credentials.setdefault(unicode(webid), set()).add(
+                make_pubkey(mod, exp))
+    return _freeze(credentials)
+
+
+def extract_credentials(graph, method=None):
+    """
+    returns a dict with the PublicKeys found in a profile graph,
+    as frozensets, by subject uri.
+    method is "triples" or "sparql" (EXTRACT_METHOD by default).
+    If the triples extraction fails, we fall back to SPARQL.
+    """
+    method = method or EXTRACT_METHOD
+    if method == "sparql":
+        return extract_credentials_sparql(graph)
+    try:
+        return extract_credentials_triples(graph)
+    except Exception, e:
+        logger.warning('triples extraction failed (%s), using sparql' % e)
+        return extract_credentials_sparql(graph)
+
+
+#
+# streaming extraction
+#
+# These do not build a graph at all: they go through the parser
+# events, and only keep the cert:key, cert:modulus and cert:exponent
+# statements. They return None when they cannot handle the content,
+# so the caller can fall back to parsing the whole profile.
+
+RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+KEY_PREDICATES = (CERT_KEY, CERT_MODULUS, CERT_EXPONENT)
+
+# rdf attributes that are not property attributes
+RDF_SYNTAX_ATTRS = ('about', 'ID', 'nodeID', 'resource', 'parseType',
+        'datatype', 'type', 'li', 'bagID', 'aboutEach', 'aboutEachPrefix')
+
+
+class KeyStatements(object):
+    """
+    collects the statements we need for building the credentials.
+    """
+    def __init__(self):
+        self.keys = list()
+        self.modulus = dict()
+        self.exponent = dict()
+
+    def add(self, s, p, o):
+        if p == CERT_KEY:
+            self.keys.append((s, o))
+        elif p == CERT_MODULUS:
+            self.modulus.setdefault(s, []).append(o)
+        elif p == CERT_EXPONENT:
+            self.exponent.setdefault(s, []).append(o)
+
+    def credentials(self):
+        credentials = dict()
+        for webid, key in self.keys:
+            for mod in self.modulus.get(key, ()):
+                for exp in self.exponent.get(key, ()):
+                    credentials.setdefault(webid, set()).add(
+                            make_pubkey(mod, exp))
+        return _freeze(credentials)
+
+
+# frame kinds for the RDF/XML handler
+NODE, PROPERTY, SKIP = range(3)
+
+
+class RDFXMLKeyHandler(xml.sax.handler.ContentHandler):
+    """
+    SAX handler that follows the RDF/XML node / property element
+    striping, and passes the cert:key, cert:modulus and cert:exponent
+    statements to a KeyStatements. Other literals are not even kept.
+    """
+    def __init__(self, base, statements):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.statements = statements
+        self.stack = list()
+        self.bases = [base]
+        self.bnodes = 0
+        self.text = None
+
+    def _bnode(self, node_id=None):
+        # named and generated blank nodes get different prefixes,
+        # so a rdf:nodeID can never be taken for a generated one.
+        if node_id:
+            return u"_:id-%s" % node_id
+        self.bnodes += 1
+        return u"_:gen-%s" % self.bnodes
+
+    def _resolve(self, uri):
+        return unicode(urljoin(self.bases[-1], uri))
+
+    def _subject(self, attrs):
+        about = attrs.get((RDF_NS, 'about'), None)
+        if about is not None:
+            return self._resolve(about)
+        rdf_id = attrs.get((RDF_NS, 'ID'), None)
+        if rdf_id is not None:
+            return self._resolve("#" + rdf_id)
+        return self._bnode(attrs.get((RDF_NS, 'nodeID'), None))
+
+    def _is_property_attr(self, ns, local):
+        return not (ns is None or ns == XML_NS or
+                (ns == RDF_NS and local in RDF_SYNTAX_ATTRS))
+
+    def _property_attrs(self, subject, attrs):
+        for (ns, local), value in attrs.items():
+            if not self._is_property_attr(ns, local):
+                continue
+            predicate = URIRef(ns + local)
+            if predicate in KEY_PREDICATES:
+                self.statements.add(subject, predicate, value)
+
+    def startElementNS(self, name, qname, attrs):
+        ns, local = name
+        base = attrs.get((XML_NS, 'base'), None)
+        self.bases.append(self._resolve(base) if base else self.bases[-1])
+        parent = self.stack[-1] if self.stack else None
+
+        if parent is None and (ns, local) == (RDF_NS, 'RDF'):
+            # the rdf:RDF wrapper: its children are node elements
+            self.stack.append((PROPERTY, None, None))
+            return
+        if parent is not None and parent[0] == SKIP:
+            self.stack.append((SKIP,))
+            return
+
+        if parent is None or parent[0] == PROPERTY:
+            # a node element
+            subject = self._subject(attrs)
+            if parent is not None and parent[1] is not None:
+                self.statements.add(parent[2], parent[1], subject)
+            self._property_attrs(subject, attrs)
+            self.stack.append((NODE, subject))
+            self.text = None
+            return
+
+        # a property element of the node at the top of the stack
+        subject = parent[1]
+        predicate = URIRef((ns or '') + local)
+        parse_type = attrs.get((RDF_NS, 'parseType'), None)
+        resource = attrs.get((RDF_NS, 'resource'), None)
+        node_id = attrs.get((RDF_NS, 'nodeID'), None)
+
+        if parse_type == 'Resource':
+            obj = self._bnode()
+            self.statements.add(subject, predicate, obj)
+            self.stack.append((NODE, obj))
+        elif parse_type is not None:
+            # Literal or Collection; we do not need them.
+            self.stack.append((SKIP,))
+        elif resource is not None or node_id is not None:
+            if resource is not None:
+                obj = self._resolve(resource)
+            else:
+                obj = self._bnode(node_id)
+            self.statements.add(subject, predicate, obj)
+            self._property_attrs(obj, attrs)
+            self.stack.append((SKIP,))
+        elif [key for key in attrs.keys() if self._is_property_attr(*key)]:
+            # an empty property element with property attributes:
+            # they describe a blank node, the object.
+            # i.e. <cert:key cert:modulus=".." cert:exponent=".."/>
+            obj = self._bnode()
+            self.statements.add(subject, predicate, obj)
+            self._property_attrs(obj, attrs)
+            self.stack.append((SKIP,))
+        else:
+            self.stack.append((PROPERTY, predicate, subject))
+            # only keep the text of the literals we need
+            if predicate in (CERT_MODULUS, CERT_EXPONENT):
+                self.text = []
+            else:
+                self.text = None
+
+    def characters(self, content):
+        if self.text is not None:
+            self.text.append(content)
+
+    def endElementNS(self, name, qname):
+        frame = self.stack.pop()
+        self.bases.pop()
+        if frame[0] == PROPERTY and frame[1] is not None and \
+                self.text is not None:
+            self.statements.add(frame[2], frame[1], u''.join(self.text))
+        self.text = None
+
+
+def extract_credentials_rdfxml(content, base):
+    """
+    returns the credentials found in a RDF/XML document, by subject,
+    going through the SAX events, without building a graph.
+    content is the whole (downloaded) document: we feed it to the
+    parser in chunks, but it is not read from the network that way.
+    """
+    statements = KeyStatements()
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, True)
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(RDFXMLKeyHandler(base, statements))
+    for start in xrange(0, len(content), STREAM_CHUNK_SIZE):
+        parser.feed(content[start:start + STREAM_CHUNK_SIZE])
+    parser.close()
+    return statements.credentials()
+
+
+NTRIPLE_RE = re.compile(
+    r'^\s*(<[^>]*>|_:\S+)\s*<([^>]*)>\s*(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*")'
+    r'(?:@[\w-]+|\^\^<[^>]*>)?\s*\.\s*(?:#.*)?$')
+
+
+def _nt_term(term):
+    if term.startswith('<'):
+        return unicode(term[1:-1])
+    if term.startswith('"'):
+        return term[1:-1].decode('unicode_escape')
+    return unicode(term)
+
+
+def extract_credentials_ntriples(content):
+    """
+    returns the credentials found in a N-Triples document, by subject,
+    line by line, without building a graph.
+    returns None if a line is not a triple (nor blank, nor a comment),
+    i.e., if it's not really N-Triples.
+    """
+    statements = KeyStatements()
+    for line in content.splitlines():
+        match = NTRIPLE_RE.match(line)
+        if match is None:
+            stripped = line.strip()
+            if stripped and not stripped.startswith('#'):
+                return None
+            continue
+        s, p, o = match.groups()
+        p = URIRef(p)
+        if p in KEY_PREDICATES:
+            statements.add(_nt_term(s), p, _nt_term(o))
+    return statements.credentials()
+
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+STREAM_EXTRACTORS = {
+    'application/rdf+xml': lambda content, base:
+        extract_credentials_rdfxml(content, base),
+    'application/n-triples': lambda content, base:
+        extract_credentials_ntriples(content),
+}
+
+
+def extract_credentials_stream(content, ctype, base):
+    """
+    returns the credentials found in a profile, by subject, without
+    building a graph; or None if we cannot stream that content type
+    (or the content could not be parsed), so the caller falls back
+    to extract_credentials on the parsed graph.
+    """
+    extractor = STREAM_EXTRACTORS.get(ctype, None)
+    if extractor is None:
+        return None
+    try:
+        return extractor(content, base)
+    except Exception, e:
+        logger.debug('streaming extraction failed: %s' % e)
+        return None
@@ -1,9 +1,21 @@
+import cookielib
+import hashlib
+import heapq
 import logging
+import Queue
+import re
 import requests
+from requests.adapters import HTTPAdapter
+import socket
 import StringIO
+import sys
+import threading
+import time
+from urlparse import urlparse, urldefrag
 from xml.sax import SAXParseException
 
 import rdflib
+from rdflib.parser import Parser as RDFParser
 rdflib_major_ver = int(rdflib.__version__.split('.')[0])
 
 if rdflib_major_ver == 3:
@@ -13,8 +25,10 @@ if rdflib_major_ver == 3:
     rdflib.plugin.register('sparql', rdflib.query.Result,
            'rdfextras.sparql.query', 'SPARQLQueryResult')
 
+from cache import LRUCache
 from serializers import Profile
-from constants import FORMATS
+from constants import FORMATS, RDFA_DTD
+from extractors import extract_credentials, extract_credentials_stream
 
 #ch = logging.StreamHandler()
 #ch.setLevel(logging.DEBUG)
@@ -23,19 +37,514 @@ logger = logging.getLogger(name=__name__)
 #logger.addHandler(ch)
 
 
-UNDERSTOOD_FORMATS = ('rdf', 'rdfa')
-#TODO leaving out turtle and n3 for now
-#have to see how should rdflib handle it
-UNDERSTOOD_CTYPES = tuple([FORMATS[f] for f in UNDERSTOOD_FORMATS])
+# JSON-LD needs the rdflib-jsonld plugin (built-in since rdflib 6)
+try:
+    rdflib.plugin.get('json-ld', RDFParser)
+    HAS_JSONLD = True
+except rdflib.plugin.PluginException:
+    try:
+        import rdflib_jsonld  # just checking it's there
+        rdflib.plugin.register('json-ld', RDFParser,
+               'rdflib_jsonld.parser', 'JsonLDParser')
+        HAS_JSONLD = True
+    except ImportError:
+        HAS_JSONLD = False
 
+# formats we ask for, cheapest to parse first, with their q-values.
+FORMAT_QVALUES = (
+        ('nt', 1.0),
+        ('turtle', 0.9),
+        ('n3', 0.8),
+        ('rdf', 0.7),
+        ('jsonld', 0.6),
+        ('rdfa', 0.5),
+)
+UNDERSTOOD_FORMATS = tuple([f for f, q in FORMAT_QVALUES
+    if f != 'jsonld' or HAS_JSONLD])
 
-def get_accept_header(ftuple):
+# the rdflib parser for each content type we understand.
+# (turtle goes through the n3 parser, which handles it in all
+# the rdflib versions). text/plain (the old n-triples type) is
+# not here: it's sniffed, so a plain text page fails profileGet.
+PARSER_FORMATS = {
+        'application/n-triples': 'nt',
+        'text/turtle': 'n3',
+        'application/x-turtle': 'n3',
+        'text/rdf+n3': 'n3',
+        'text/n3': 'n3',
+        'application/rdf+xml': 'xml',
+        'application/ld+json': 'json-ld',
+        'application/xhtml+xml': 'rdfa',
+}
+UNDERSTOOD_CTYPES = tuple([ctype for ctype, parser in PARSER_FORMATS.items()
+    if parser != 'json-ld' or HAS_JSONLD])
+ASKABLE_CTYPES = tuple([FORMATS[f] for f in UNDERSTOOD_FORMATS])
+
+
+# connection pool settings for the shared session.
+# pool_connections is the number of hosts we keep a pool for,
+# pool_maxsize the number of keep-alive connections per host.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+POOL_BLOCK = False
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class NoCookiesPolicy(cookielib.DefaultCookiePolicy):
+    """
+    a cookie policy that neither keeps nor sends any cookie.
+    The session is shared by the validations of all the users, so a
+    profile host must not be able to follow a user across them.
+    """
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+def new_session(pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE, pool_block=POOL_BLOCK, max_retries=0):
+    """
+    returns a new requests session with a keep-alive connection pool.
+    if pool_block is True, pool_maxsize is a hard limit for the
+    connections opened to a single host.
+    the session does not keep the cookies set by the hosts
+    (see NoCookiesPolicy).
+    """
+    session = requests.Session()
+    session.cookies.set_policy(NoCookiesPolicy())
+    adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    returns the session shared by all the WebIDLoaders in this
+    process that have not been given one, creating it the first time.
+    """
+    global _session
+    if _session is None:
+        _session_lock.acquire()
+        try:
+            if _session is None:
+                _session = new_session()
+        finally:
+            _session_lock.release()
+    return _session
+
+
+def set_session(session):
+    """
+    replaces the shared session (i.e., one created with
+    new_session and different pool settings).
+    """
+    global _session
+    _session = session
+
+
+# limits for dereferencing a profile.
+# TIMEOUT is a (connect, read) tuple of seconds, as taken by requests;
+# MAX_BYTES is the max size of a profile, and MAX_TIME the max seconds
+# we spend downloading its body. Downloads over limits are aborted.
+TIMEOUT = (5, 10)
+MAX_BYTES = 2 * 1024 * 1024
+MAX_TIME = 20
+CHUNK_SIZE = 16 * 1024
+
+
+class DownloadAborted(Exception):
+    """
+    Raised when the download of a profile goes over the limits.
+    """
+    pass
+
+
+def response_socket(req):
+    """
+    returns the socket a (streamed) response is read from,
+    or None if we cannot get to it.
+    """
+    conn = getattr(req.raw, '_connection', None)
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        # python2 httplib: the response reads from a socket file
+        fp = getattr(getattr(req.raw, '_fp', None), 'fp', None)
+        sock = getattr(fp, '_sock', None)
+    # pyopenssl wraps the real socket
+    return getattr(sock, 'socket', sock)
+
+
+def abort_download(req):
+    """
+    shuts down the socket of a (streamed) response, so a read
+    blocked on it (in another thread) returns at once.
+    """
+    sock = response_socket(req)
+    if sock is None:
+        req.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+class Watchdog(object):
+    """
+    Calls functions when their time comes, from a single thread
+    shared by all the downloads (see read_content), so we do not
+    start a timer thread for each of them.
+    """
+    def __init__(self):
+        # heap of [when, seq, func]; func is None once cancelled.
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def watch(self, seconds, func):
+        """
+        calls func in seconds, unless cancelled before.
+        returns the entry to cancel it with.
+        """
+        self._cond.acquire()
+        try:
+            self._seq += 1
+            entry = [time.time() + seconds, self._seq, func]
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                        name='webid-watchdog')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        return entry
+
+    def cancel(self, entry):
+        """
+        once this returns, the func of entry has either been called
+        already, or it will never be.
+        """
+        self._cond.acquire()
+        try:
+            entry[2] = None
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        self._cond.acquire()
+        try:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                left = self._heap[0][0] - time.time()
+                if left > 0:
+                    self._cond.wait(left)
+                    continue
+                entry = heapq.heappop(self._heap)
+                func, entry[2] = entry[2], None
+                if func is None:
+                    continue
+                # called with the lock held (see cancel), so it
+                # has to be quick.
+                try:
+                    func()
+                except Exception, e:
+                    logger.debug('watchdog call failed: %s' % e)
+        finally:
+            self._cond.release()
+
+
+# shared by all the downloads in the process.
+_watchdog = Watchdog()
+
+
+# max number of threads used to dereference the URIs
+# of a single certificate.
+MAX_FETCH_WORKERS = 4
+
+
+def get_all(loaders, max_workers=MAX_FETCH_WORKERS):
+    """
+    calls load() on all the given loaders, concurrently, using at most
+    max_workers threads.
+    returns a list with the exc_info of the exception raised by each
+    loader (or None), in the same order as the loaders.
+    """
+    errors = [None] * len(loaders)
+
+    def _get(i):
+        try:
+            loaders[i].load()
+        except Exception:
+            errors[i] = sys.exc_info()
+
+    if len(loaders) <= 1 or max_workers <= 1:
+        for i in range(len(loaders)):
+            _get(i)
+        return errors
+
+    pending = Queue.Queue()
+    for i in range(len(loaders)):
+        pending.put(i)
+
+    def _worker():
+        while True:
+            try:
+                i = pending.get_nowait()
+            except Queue.Empty:
+                return
+            _get(i)
+
+    workers = [threading.Thread(target=_worker)
+            for _ in range(min(max_workers, len(loaders)))]
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return errors
+
+
+class SingleFlight(object):
+    """
+    Deduplicates concurrent calls for the same key: while a call
+    for a key is in flight, other callers for that key wait for it
+    and get its result (or its exception) instead of doing the
+    work again. Nothing is kept once the call has finished.
+    """
+    def __init__(self):
+        # key -> [event, result, exc_info]
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        returns func(), or the result of the call for key that
+        is already in flight.
+        """
+        self._lock.acquire()
+        call = self._calls.get(key, None)
+        if call is not None:
+            self._lock.release()
+            logger.debug('waiting for in-flight call for %s' % (key,))
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2][0], call[2][1], call[2][2]
+            return call[1]
+        call = [threading.Event(), None, None]
+        self._calls[key] = call
+        self._lock.release()
+        try:
+            try:
+                call[1] = func()
+            except Exception:
+                call[2] = sys.exc_info()
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call[0].set()
+        return call[1]
+
+    def in_flight(self):
+        return len(self._calls)
+
+
+# shared by all the loaders in the process.
+_flights = SingleFlight()
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker.
+    After failure_threshold consecutive failed dereferences on a
+    host, the circuit for that host is open: fetches fail fast,
+    without touching the network, for reset_timeout seconds. Then
+    one fetch is let through; if it succeeds the circuit is closed
+    again, otherwise it stays open for another reset_timeout.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # host -> [consecutive failures, opened at]
+        self._hosts = dict()
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        """
+        returns True if we can try to fetch from host.
+        """
+        self._lock.acquire()
+        try:
+            state = self._hosts.get(host, None)
+            if state is None or state[1] is None:
+                return True
+            now = time.time()
+            if now - state[1] >= self.reset_timeout:
+                # half-open: let this one through, and keep
+                # the others out until it finishes.
+                state[1] = now
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def record_success(self, host):
+        self._lock.acquire()
+        try:
+            self._hosts.pop(host, None)
+        finally:
+            self._lock.release()
+
+    def record_failure(self, host):
+        self._lock.acquire()
+        try:
+            state = self._hosts.setdefault(host, [0, None])
+            state[0] += 1
+            if state[0] >= self.failure_threshold:
+                state[1] = time.time()
+        finally:
+            self._lock.release()
+
+    def state(self, host):
+        """
+        returns "closed", "open" or "half-open".
+        """
+        state = self._hosts.get(host, None)
+        if state is None or state[1] is None:
+            return "closed"
+        if time.time() - state[1] >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def failures(self, host):
+        state = self._hosts.get(host, None)
+        return state[0] if state else 0
+
+
+def get_accept_header(ftuple, first=None):
     """
     input: format tuple.
     returns a string containing the accepted formats in the
-    preferred order.
+    preferred order, with their q-values.
+    first is an optional content type we want most of all
+    (i.e., the one that worked last time for a host).
     """
-    return '; '.join([FORMATS[f] for f in UNDERSTOOD_FORMATS])
+    qvalues = dict(FORMAT_QVALUES)
+    accept = []
+    if first:
+        accept.append(first)
+    for f in ftuple:
+        if FORMATS[f] == first:
+            continue
+        q = qvalues.get(f, 0.1)
+        if q == 1.0 and not first:
+            accept.append(FORMATS[f])
+        else:
+            accept.append('%s;q=%.1f' % (FORMATS[f], min(q, 0.9)))
+    return ', '.join(accept)
+
+
+# the content type that worked last time, by host.
+_host_formats = LRUCache(maxsize=1000)
+
+
+def get_host_format(host):
+    return _host_formats.get(host, None)
+
+
+def set_host_format(host, ctype):
+    # we only remember the types we can ask for.
+    if ctype in ASKABLE_CTYPES:
+        _host_formats.set(host, ctype)
+
+
+# permanent redirect targets, by (original) profile uri.
+# they are followed again from the start after REDIRECT_TTL seconds,
+# or as soon as the target does not serve the profile.
+PERMANENT_REDIRECTS = (301, 308)
+REDIRECT_TTL = 24 * 60 * 60
+_redirects = LRUCache(maxsize=1000, ttl=REDIRECT_TTL)
+
+
+def get_redirect(uri):
+    """
+    returns the location uri was permanently redirected to, or None.
+    """
+    return _redirects.get(uri, None)
+
+
+def forget_redirect(uri):
+    _redirects.invalidate(uri)
+
+
+def remember_redirects(uri, req):
+    """
+    remembers the furthest location reached from uri through
+    permanent redirects only, so next fetches can go straight there.
+    """
+    hops = list(req.history) + [req]
+    target = None
+    for i, hop in enumerate(req.history):
+        if hop.status_code not in PERMANENT_REDIRECTS:
+            break
+        target = hops[i + 1].url
+    if target and target != uri:
+        logger.debug('remembering redirect %s -> %s' % (uri, target))
+        _redirects.set(uri, target)
+
+
+SNIFF_BYTES = 1024
+# a turtle (or n-triples) document starting with a statement.
+# the subject has to look like an IRI (empty, or with a ':', '#'
+# or '/'), so tags like <html> are not taken for one.
+TRIPLE_START_RE = re.compile(r'^(<>|<[^<>\s]*[:#/][^<>\s]*>|_:\S+)\s')
+# the root element of a RDF/XML document (rdf:RDF, or RDF with
+# a default namespace)
+RDF_ELEMENT_RE = re.compile(r'<([\w.-]+:)?RDF[\s>]')
+
+
+def sniff_content_type(content):
+    """
+    guesses the content type of a profile from its first bytes.
+    returns None if it does not look like anything we understand.
+    """
+    head = content[:SNIFF_BYTES].lstrip()
+    if RDFA_DTD in head:
+        return FORMATS['rdfa']
+    # before looking for xml: statements can use the rdf: IRIs.
+    if TRIPLE_START_RE.match(head):
+        return FORMATS['turtle']
+    if head.startswith('<'):
+        if '<html' in head.lower():
+            return FORMATS['rdfa']
+        if head.startswith('<?xml') or RDF_ELEMENT_RE.search(head):
+            return FORMATS['rdf']
+        return None
+    if head.startswith('{') or head.startswith('['):
+        if '"@context"' in head and HAS_JSONLD:
+            return FORMATS['jsonld']
+        return None
+    if '@prefix' in head or '@base' in head or \
+            head.upper().startswith('PREFIX'):
+        return FORMATS['turtle']
+    return None
 
 
 class WebIDLoader(object):
@@ -43,12 +552,47 @@ class WebIDLoader(object):
     class that encapsulates the fetching and
     parsing of a WebID Profile
     """
-    def __init__(self, uri, preferred_format=None, **kwargs):
+    def __init__(self, uri, preferred_format=None, session=None,
+            cache=None, **kwargs):
         """
         preferred_format may be either a content-type, or
         the shortname for one of the known formats.
+        session is the requests session used for fetching; if not
+        given, the shared session (see get_session) is used.
+        cache is an optional cache.ProfileCache.
+        negative_cache is an optional cache.NegativeCache, where
+        failed dereferences are remembered for a short time.
+        breaker is an optional CircuitBreaker.
+        timeout, max_bytes and max_time are the download limits
+        (see TIMEOUT, MAX_BYTES and MAX_TIME).
+        if streaming is True, get_credentials extracts the keys from
+        the parser events, without building a graph, when it can.
         """
         self.uri = uri
+        # the url we finally got the profile from, after redirects.
+        # uri is still the claimed WebID (profile).
+        self.location = None
+        self.session = session or get_session()
+        self.cache = cache
+        # the cache entry for this profile, and whether we
+        # got the content from it (fresh or revalidated).
+        self.cached = None
+        self.from_cache = False
+        # pubkeys found in the profile, by subject
+        # (see get_credentials)
+        self.credentials = None
+        self.negative_cache = kwargs.get('negative_cache', None)
+        self.breaker = kwargs.get('breaker', None)
+        self.host = urlparse(uri).netloc
+        # the host we actually requested (see target)
+        self.request_host = self.host
+        self.timeout = kwargs.get('timeout', TIMEOUT)
+        self.max_bytes = kwargs.get('max_bytes', MAX_BYTES)
+        self.max_time = kwargs.get('max_time', MAX_TIME)
+        self.streaming = kwargs.get('streaming', False)
+        # whether we could get the profile, and why not, if so.
+        self.ok = None
+        self.reason = None
         if preferred_format:
             self.preferred_format = preferred_format
         # XXX TODO pass verify option
@@ -58,16 +602,97 @@ class WebIDLoader(object):
         self.graph = None
         self.rcontent = None
         self.rheaders = None
-        self.rawprofile = None
+        # see rawprofile
+        self._rawprofile = None
+        self.rawprofile_cache = kwargs.get('rawprofile_cache', None)
+        # the exc_info of a failed parse in load, if any.
+        self.parse_error = None
 
         self.ctype = None
         # for multiple content tries
         self.responses = dict()
         self.tried_formats = list()
 
+    # what a loader takes from the one that did the work, when they
+    # were loading the same document at the same time (see load).
+    SHARED_STATE = ('ok', 'reason', 'location', 'cached', 'from_cache',
+            'rcontent', 'rheaders', 'rstatus_code', 'ctype', 'format',
+            'graph', 'credentials', 'responses', 'tried_formats',
+            'parse_error')
+    # the small containers are copied, so each loader gets its own.
+    # the graph is shared as it is: nobody changes it once parsed.
+    COPIED_STATE = {'credentials': dict, 'responses': dict,
+            'tried_formats': list}
+
+    def load(self):
+        """
+        get()s the profile and extracts its credentials.
+        Concurrent loads of the same document (i.e., by validators of
+        other requests in a threaded server) are deduplicated: only one
+        of them dereferences and parses it, the others wait for it and
+        share its state, including the parsed graph and the keys
+        (or the parse error).
+        Only loaders with the same settings share (see flight_key).
+        returns True if the profile could be got.
+        """
+        key = self.flight_key()
+        loader = _flights.do(key, self._load)
+        if loader is not self:
+            logger.debug('sharing in-flight load of %s' % key[0])
+            self.share(loader)
+        return bool(self.ok)
+
+    def flight_key(self):
+        """
+        the key of our load in the single-flight: the document and the
+        settings that change how it's loaded. The objects we use
+        (session, caches, breaker) are compared by identity.
+        """
+        return (urldefrag(self.uri)[0],
+                self.timeout, self.max_bytes, self.max_time,
+                getattr(self, 'preferred_format', None),
+                self.streaming, self.verify_server_cert,
+                id(self.session), id(self.cache),
+                id(self.negative_cache), id(self.breaker))
+
+    def _load(self):
+        if self.get():
+            try:
+                self.get_credentials()
+            except Exception, e:
+                # the graph and credentials are left unset, and the
+                # error is kept, so whoever asks for them gets it
+                # (without parsing again).
+                logger.debug('could not extract credentials from %s: %s'
+                        % (self.uri, e))
+                self.parse_error = sys.exc_info()
+        return self
+
+    def share(self, other):
+        """
+        takes the state of another loader of the same document
+        (see SHARED_STATE and COPIED_STATE).
+        """
+        for attr in self.SHARED_STATE:
+            value = getattr(other, attr, None)
+            if value is not None and attr in self.COPIED_STATE:
+                value = self.COPIED_STATE[attr](value)
+            setattr(self, attr, value)
+
+    def get_response_ctype(self, req):
+        ctype = req.headers.get('content-type', None)
+        if ctype:
+            ctype = ctype.split(";")[0].strip().lower()
+        return ctype
+
     def get(self):
         """
         de-references the uri, handling content-negotiation.
+        If uri has been permanently redirected before, we go straight
+        to the last location we know of. If we get a 406, or a content
+        type we cannot use for a preferred (narrow) Accept, we do one
+        more request with a broader Accept. As a last resort we sniff
+        the content.
         """
         logger.debug('loading webid: %s' % self.uri)
         preffmt = getattr(self, 'preferred_format', None)
@@ -83,58 +708,222 @@ class WebIDLoader(object):
         logger.debug('accept_header: %s' % accept_header)
         if accept_header:  # we got a preference on init.
             logger.debug('using preferred format %s' % preffmt)
-            req = requests.get(self.uri,
-                verify=self.verify_server_cert,
-                headers={"accept": accept_header})
+            narrow = True
         else:  # no accept header, go with default preferred fmts.
             logger.debug('using all understood formats')
-            req = requests.get(self.uri,
-                verify=self.verify_server_cert,
-                headers={"accept": get_accept_header(UNDERSTOOD_FORMATS)})
+            accept_header = get_accept_header(UNDERSTOOD_FORMATS,
+                    first=get_host_format(self.host))
+            narrow = False
+        headers = {"accept": accept_header}
+
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.lookup(self.uri)
+        if entry is not None:
+            if entry.is_fresh:
+                logger.debug('using cached profile for uri %s' % self.uri)
+                self.load_cached(entry)
+                return True
+            headers.update(entry.conditional_headers())
+
+        if self.negative_cache is not None:
+            reason = self.negative_cache.lookup(self.uri)
+            if reason is not None:
+                self.fail("%s (cached failure)" % reason, record=False)
+                return False
+        host = urlparse(self.target()).netloc
+        if self.breaker is not None and not self.breaker.allow(host):
+            self.fail("circuit breaker open for host %s after %s failures"
+                    % (host, self.breaker.failures(host)),
+                    record=False)
+            return False
+
+        req = self.request(headers)
+        if req is None:
+            return False
+        ctype = self.get_response_ctype(req)
+        if req.status_code == 406 or \
+                (narrow and req.ok and ctype not in UNDERSTOOD_CTYPES):
+            # one more try, with a broader accept.
+            logger.debug('got %s (%s) for %s, trying a broader accept' % (
+                req.status_code, ctype, headers['accept']))
+            req.close()
+            if narrow:
+                headers['accept'] = get_accept_header(UNDERSTOOD_FORMATS)
+            else:
+                headers['accept'] = '*/*'
+            req = self.request(headers)
+            if req is None:
+                return False
+            ctype = self.get_response_ctype(req)
+
+        if entry is not None and req.status_code == 304:
+            logger.debug('cached profile still valid for uri %s' % self.uri)
+            req.close()
+            entry.refresh(req.headers)
+            self.cache.update(entry)
+            self.load_cached(entry, status_code=req.status_code)
+            return True
         if req.ok:
             logger.debug('successful URI dereference for uri %s' % self.uri)
-            ctype = req.headers.get('content-type', None)
-            if ctype:
-                ctype = ctype.split(";")[0]
             logger.debug('content-type: %s' % ctype)
+            try:
+                content = self.read_content(req)
+            except DownloadAborted, e:
+                self.fail("download aborted: %s" % e)
+                return False
+            except requests.RequestException, e:
+                self.fail("could not fetch the profile: %s" % e,
+                        host_error=True)
+                return False
             if ctype in UNDERSTOOD_CTYPES:
-                logger.debug('saving state...')
-                self.save_state(req)
-                # we're happy... for now.
-                logger.info('successfully got content for uri %s' % self.uri)
-                return True
+                set_host_format(self.host, ctype)
             else:
                 logger.debug('do not understand content-type of response...')
-                self.ok = False
-                #XXX DEBUG
-                self.req = req
+                sniffed = sniff_content_type(content)
+                if sniffed is None:
+                    self.fail("unknown content type: %s" % ctype,
+                            record=False)
+                    #XXX DEBUG
+                    self.req = req
+                    return False
+                logger.debug('content sniffed as %s' % sniffed)
+                ctype = sniffed
+            logger.debug('saving state...')
+            self.save_state(req, content=content, ctype=ctype)
+            # we're happy... for now.
+            logger.info('successfully got content for uri %s' % self.uri)
+            return True
+
+        logger.debug('not a valid response.')
+        logger.debug('status code: %s' % req.status_code)
+        self.rstatus_code = req.status_code
+        req.close()
+        # the breaker has already been told.
+        self.fail("response status code: %s" % req.status_code,
+                host_error=False)
+        return False
 
+    def target(self):
+        """
+        returns the url we request for the uri: the last location it
+        has been permanently redirected to, or the uri itself.
+        """
+        return get_redirect(self.uri) or self.uri
+
+    def request(self, headers):
+        """
+        does a (streamed) GET on the target of the uri; returns the
+        response, or None if the request failed (we are marked as
+        failed then). The breaker is told about the host we requested.
+        """
+        self.tried_formats.append(headers['accept'])
+        url = self.target()
+        self.request_host = urlparse(url).netloc
+        try:
+            req = self.session.get(url,
+                verify=self.verify_server_cert,
+                headers=headers,
+                timeout=self.timeout,
+                stream=True)
+        except requests.RequestException, e:
+            if url != self.uri:
+                forget_redirect(self.uri)
+            self.fail("could not fetch the profile: %s" % e, host_error=True)
+            return None
+        self.location = req.url
+        if 200 <= req.status_code < 300 or req.status_code == 304:
+            remember_redirects(self.uri, req)
         else:
-            logger.debug('not a valid response.')
-            logger.debug('status code: %s' % req.status_code)
-        logger.debug('we did not get a proper response :(')
-        logger.debug('we need to know if it was 404, 500, or what')
-        logger.debug('doing nothing...')
-        # else: loop over rest of understood formats.
-        # if we had been given a preference, try with the broader accept.
-        # try to use conneg features if given.
-        # XXX if response code is 406, look for which of the alternates
-        # can we understand.
-
-    def save_state(self, req):
+            # next time, follow the redirects from the start again.
+            forget_redirect(self.uri)
+        if self.breaker is not None:
+            if req.status_code >= 500:
+                self.breaker.record_failure(self.request_host)
+            else:
+                self.breaker.record_success(self.request_host)
+        return req
+
+    def fail(self, reason, record=True, host_error=False):
+        """
+        marks this dereference as failed, for the given reason.
+        if record is True, the failure is remembered in the negative
+        cache, and, if it was the host's fault, told to the breaker.
+        """
+        logger.debug('failed dereference for uri %s: %s' % (
+            self.uri, reason))
+        self.ok = False
+        self.reason = reason
+        if not record:
+            return
+        if self.negative_cache is not None:
+            self.negative_cache.store(self.uri, reason)
+        if host_error and self.breaker is not None:
+            self.breaker.record_failure(self.request_host)
+
+    def read_content(self, req):
+        """
+        reads the body of a (streamed) response, in chunks, and
+        raises DownloadAborted as soon as it goes over max_bytes,
+        or takes more than max_time seconds.
+        the watchdog shuts the download down when max_time is over, so
+        a host sending a byte now and then cannot keep us waiting.
+        """
+        length = req.headers.get('content-length', None)
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            req.close()
+            raise DownloadAborted("content-length %s is over %s bytes" % (
+                length, self.max_bytes))
+        deadline = time.time() + self.max_time
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            abort_download(req)
+
+        watch = _watchdog.watch(self.max_time, expire)
+        chunks = []
+        size = 0
+        try:
+            try:
+                for chunk in req.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        req.close()
+                        raise DownloadAborted("profile is over %s bytes" % (
+                            self.max_bytes))
+                    if time.time() > deadline:
+                        expired.set()
+                        break
+                    chunks.append(chunk)
+            except DownloadAborted:
+                raise
+            except Exception:
+                # the read fails when the watchdog shuts the socket down
+                if not expired.isSet():
+                    raise
+        finally:
+            _watchdog.cancel(watch)
+        if expired.isSet():
+            req.close()
+            raise DownloadAborted("download took over %s seconds" % (
+                self.max_time))
+        return ''.join(chunks)
+
+    def save_state(self, req, content=None, ctype=None):
         """
         saves the content of a successful response into this instance,
-        for later use.
+        for later use. content is the body, if it has already been
+        read (see read_content); ctype overrides the content type of
+        the response (i.e., a sniffed one).
         """
         #XXX only for DEBUG, do not save whole req object!
         #self.r = req
 
-        self.rcontent = req.content
+        self.rcontent = content if content is not None else req.content
         self.rheaders = req.headers
         self.rstatus_code = req.status_code
-        ctype = req.headers.get('content-type', None)
-        if ctype:
-            ctype = ctype.split(";")[0]
+        ctype = ctype or self.get_response_ctype(req)
         self.ctype = ctype
         self.ok = req.ok
         self.format = ctype
@@ -142,18 +931,54 @@ class WebIDLoader(object):
         # the earl validation on webid-auth package.
         self.responses[ctype] = req
 
+        if self.cache is not None:
+            credentials = None
+            previous = self.cache.lookup(self.uri)
+            if previous is not None and previous.content_hash == \
+                    hashlib.sha1(self.rcontent).hexdigest():
+                # same content we had; no need to parse it again.
+                credentials = previous.credentials
+            self.cached = self.cache.store(self.uri, self.rcontent,
+                    ctype, req.headers, req.status_code,
+                    credentials=credentials)
+            if self.cached is not None:
+                self.credentials = self.cached.credentials
+
+    def load_cached(self, entry, status_code=None):
+        """
+        loads the state saved in a cache entry, as if we had just
+        got it from the network.
+        """
+        self.cached = entry
+        self.from_cache = True
+        self.rcontent = entry.content
+        self.rheaders = entry.headers
+        self.rstatus_code = status_code or entry.status_code
+        self.ctype = entry.ctype
+        self.format = entry.ctype
+        self.ok = True
+        self.credentials = entry.credentials
+
     def parse(self, format=None):
         """
         tries to parse the content of the request into
-        an rdf graph.
+        an rdf graph. A parse error of load is raised again,
+        unless another format is given.
         """
-        self.graph = rdflib.ConjunctiveGraph()
-        format = format or self.format
+        if format is None and self.parse_error is not None:
+            error = self.parse_error
+            raise error[0], error[1], error[2]
+        graph = rdflib.ConjunctiveGraph()
+        format = format or PARSER_FORMATS.get(self.format, self.format)
         try:
             _f = StringIO.StringIO(self.rcontent)
-            self.graph.load(_f, format=format)
-            self.rawprofile = Profile(
-                    self.graph.serialize(format="pretty-xml"))
+            # relative URIs are resolved against the document uri
+            # (not the one we may have been redirected to), so the
+            # subjects match the WebIDs in the cert.
+            graph.load(_f, format=format,
+                    publicID=urldefrag(self.uri)[0])
+            # only keep the graph if it was parsed completely.
+            self.graph = graph
             return True
         except SAXParseException:
             #malformed rdfa
@@ -163,7 +988,73 @@ class WebIDLoader(object):
             #return False
             #ConnectionError (we should put some "reason" field on the test@!!
 
-    #XXX move here the SPARQL queries also???
+    @property
+    def rawprofile(self):
+        """
+        the profile reserialized as pretty-xml (a serializers.Profile),
+        for the earl report. pretty-xml is really slow, so the profile
+        is only serialized when the dump of the Profile is first read,
+        i.e., when the report is written (see serialize_profile).
+        returns None if we got no profile, or could not parse it.
+        """
+        if self._rawprofile is None and self.rcontent is not None and \
+                self.parse_error is None:
+            self._rawprofile = Profile(self.serialize_profile)
+        return self._rawprofile
+
+    def serialize_profile(self):
+        """
+        returns the profile reserialized as pretty-xml, or None if it
+        could not be parsed. If we have a rawprofile_cache (a
+        cache.LRUCache), it's kept there by content hash.
+        """
+        content_hash = None
+        if self.rawprofile_cache is not None:
+            content_hash = hashlib.sha1(self.rcontent).hexdigest()
+            dump = self.rawprofile_cache.get(content_hash)
+            if dump is not None:
+                return dump
+        try:
+            if self.graph is None:
+                self.parse()
+        except Exception, e:
+            logger.debug('could not parse profile %s: %s' % (self.uri, e))
+            return None
+        dump = self.graph.serialize(format="pretty-xml")
+        if content_hash is not None:
+            self.rawprofile_cache.set(content_hash, dump, size=len(dump))
+        return dump
+
+    def get_credentials(self, webid=None):
+        """
+        returns a frozenset with the public keys of a WebID found in
+        the profile (or all the keys in the profile, if no webid is
+        given), parsing the profile first if needed.
+        The keys of all the subjects are extracted at once, so several
+        WebIDs sharing this profile only cost one extraction. With
+        streaming, the profile is not parsed into a graph for this. If we got
+        the profile from the cache, the keys extracted the last time
+        are reused, and the profile is not parsed at all.
+        """
+        if self.credentials is None:
+            if self.parse_error is not None:
+                error = self.parse_error
+                raise error[0], error[1], error[2]
+            if self.graph is None and self.streaming:
+                self.credentials = extract_credentials_stream(
+                        self.rcontent, self.ctype, urldefrag(self.uri)[0])
+            if self.credentials is None:
+                if self.graph is None:
+                    self.parse()
+                self.credentials = extract_credentials(self.graph)
+            if self.cached is not None:
+                self.cached.credentials = self.credentials
+        if webid is None:
+            keys = set()
+            for subject_keys in self.credentials.values():
+                keys.update(subject_keys)
+            return frozenset(keys)
+        return self.credentials.get(webid, frozenset())
 
 
 
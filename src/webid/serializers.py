@@ -1,3 +1,5 @@
+import hashlib
+import re
 import uuid
 try:
     from collections import namedtuple
@@ -22,19 +24,72 @@ class Id(object):
     base class that adds an uuid identifier
     to derived objects. Used for generating the
     rdf graph for the earl results report.
+    The uuid is only generated when it is first used
+    (for the report), since uuid4 reads from urandom.
+    Subclasses can declare __slots__ (with a '_uuid' slot).
     """
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
-        self.uuid = uuid.uuid4()
         super(Id, self).__init__()
 
+    @property
+    def uuid(self):
+        _uuid = getattr(self, '_uuid', None)
+        if _uuid is None:
+            _uuid = self._uuid = uuid.uuid4()
+        return _uuid
+
     def id_uuid(self):
         return u"uuid%s" % unicode(self.uuid)
 
 
+# formatting found in modulus literals (and in the hex M2Crypto gives)
+MODULUS_JUNK_RE = re.compile(r'[\s":]+')
+
+
+def normalize_modulus(mod):
+    """
+    returns the canonical form of a RSA modulus: lowercase hex,
+    without whitespace, quotes, colons or leading zeros.
+    mod can be an int or a hex string (unicode or str).
+    """
+    if mod is None:
+        return None
+    if isinstance(mod, (int, long)):
+        return '%x' % mod
+    if isinstance(mod, unicode):
+        mod = mod.encode('ascii', 'ignore')
+    mod = MODULUS_JUNK_RE.sub('', mod).lower()
+    return mod.lstrip('0') or mod[:1]
+
+
 PK = namedtuple('PublicKey', ['mod', 'exp'])
 
 
 class PublicKey(PK, Id):
+    """
+    A RSA public key, as found in the cert or in a profile.
+    The modulus is kept in canonical form (see normalize_modulus),
+    so the keys of both sides match regardless of formatting.
+    Keys compare and hash by a fixed-size digest, computed once.
+    """
+    def __new__(cls, mod=None, exp=None):
+        return PK.__new__(cls, normalize_modulus(mod), exp)
+
+    def __init__(self, *args, **kwargs):
+        self.digest = hashlib.sha1('%s:%s' % (self.mod, self.exp)).digest()
+        super(PublicKey, self).__init__(*args, **kwargs)
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, PublicKey) and self.digest == other.digest
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
     def to_rdf(self):
         iduuid = "%(id)s-serialized-xml" % {'id': self.uuid}
         return PUBKEY_RDF % {
@@ -47,11 +102,22 @@ class Profile(Id):
     """
     A Container Class for profile objects
     (dereferenced URIs contained in the WebID cert SAN).
+    dump can also be a function, which is only called (once) when
+    the dump is first read, i.e., when the report is written.
     """
+    __slots__ = ('_uuid', '_dump')
+
     def __init__(self, dump, *args, **kwargs):
-        self.dump = dump
+        self._uuid = None
+        self._dump = dump
         super(Profile, self).__init__(*args, **kwargs)
 
+    @property
+    def dump(self):
+        if callable(self._dump):
+            self._dump = self._dump()
+        return self._dump
+
 
 class WebIDClaim(Id):
     """
@@ -59,7 +125,10 @@ class WebIDClaim(Id):
     It's initialized with the claimedURI and the Public
     Key that it ties together.
     """
+    __slots__ = ('_uuid', 'claimedURI', 'pubkey')
+
     def __init__(self, claimedURI, pk, *args, **kwargs):
+        self._uuid = None
         self.claimedURI = claimedURI
         self.pubkey = PublicKey() if pk is None else pk
         super(WebIDClaim, self).__init__(*args, **kwargs)
@@ -1,14 +1,16 @@
 from collections import defaultdict
 from datetime import datetime
 from itertools import chain
+from urlparse import urldefrag
 import re
 import logging
+import threading
 
 import constants
-from webidchecks import WebIDChecks
-from serializers import Id, PublicKey, WebIDClaim
-from cert import Cert
-from fetcher import WebIDLoader
+from webidchecks import get_testbed
+from serializers import Id, WebIDClaim
+from cert import Cert, get_fingerprint
+from fetcher import WebIDLoader, get_all, MAX_FETCH_WORKERS
 
 logger = logging.getLogger(name=__name__)
 
@@ -19,15 +21,255 @@ WEBID_RAISE_EXCEPTIONS = False
 class TestResult(Id):
     """
     Encapsulates Result of a Test
+    Fixed layout (there can be many of them per validation):
+    the outcome, the report fields (see CheckPlan) and the
+    uri / pubkey the test was run for.
     """
+    __slots__ = ('_uuid', 'passed', 'pointer', 'subject', 'details',
+            'uri', 'pubkey', 'xmlserialized')
+
     def __init__(self, *args, **kwargs):
+        self._uuid = None
         self.passed = kwargs.get('passed', False)
         self.pointer = None
         self.subject = None
         self.details = None
+        self.uri = kwargs.get('uri', None)
+        self.pubkey = kwargs.get('pubkey', None)
+        #see get_testinfo_webid_pubkey_serialized
+        self.xmlserialized = False
         super(TestResult, self).__init__(*args, **kwargs)
 
 
+class ValidationResults(object):
+    """
+    Per-validation results context.
+    Holds the TestResults of a validate() run, by test name,
+    so the shared testbed is never written to.
+    It also keeps (total, failed) counters indexed by test name,
+    (test name, uri) and (test name, uri, pubkey), so composite
+    tests can be resolved without scanning the results.
+    """
+    def __init__(self):
+        self.results = dict()
+        # how many checks were run, and how many of them failed
+        self.run = 0
+        self.failed = 0
+        # checks skipped (see WebIDValidator.prune), by test name
+        self.skipped = dict()
+        # outcomes of the pubkey checks, by uri, as columns:
+        # uri -> (keys, {test name: [outcome for each key]})
+        # (None for the skipped ones).
+        self.columns = dict()
+        self._last = dict()
+        self._by_test = dict()
+        self._by_uri = dict()
+        self._by_key = dict()
+
+    def _count(self, index, key, passed):
+        counter = index.get(key, None)
+        if counter is None:
+            counter = index[key] = [0, 0]
+        counter[0] += 1
+        if not passed:
+            counter[1] += 1
+
+    def add(self, name, passed, uri=None, pubkey=None, result=None):
+        """
+        records the outcome of a test.
+        """
+        if result is not None:
+            self.results.setdefault(name, []).append(result)
+        self.run += 1
+        if not passed:
+            self.failed += 1
+        self._last[name] = passed
+        self._count(self._by_test, name, passed)
+        self._count(self._by_uri, (name, uri), passed)
+        self._count(self._by_key, (name, uri, pubkey), passed)
+
+    def skip(self, name, times=1):
+        """
+        records that a check was skipped.
+        """
+        self.skipped[name] = self.skipped.get(name, 0) + times
+
+    @property
+    def skipped_count(self):
+        return sum(self.skipped.values())
+
+    def count(self, name, uri=None, pubkey=None):
+        """
+        returns a (total, failed) tuple for the results of a test,
+        filtered by uri and pubkey.
+        """
+        if uri and pubkey:
+            counter = self._by_key.get((name, uri, pubkey), None)
+        elif uri:
+            counter = self._by_uri.get((name, uri), None)
+        elif not pubkey:
+            counter = self._by_test.get(name, None)
+        else:
+            counter = None
+        if counter is None:
+            return 0, 0
+        return counter[0], counter[1]
+
+    def get(self, name):
+        """
+        returns a tuple with all the results for a given test name.
+        """
+        return tuple(self.results.get(name, ()))
+
+    def last(self, name):
+        """
+        returns the last result for a given test name, or None.
+        """
+        results = self.results.get(name, None)
+        if results:
+            return results[-1]
+
+    def last_passed(self, name):
+        """
+        returns the outcome of the last run of a given test,
+        or None if it was never run. Works also when no
+        TestResult objects are being kept.
+        """
+        return self._last.get(name, None)
+
+
+# the fields of a TestResult filled from the get_testinfo_* methods,
+# as named by the spec classes.
+INFO_FIELDS = ("details", "subject", "pointer")
+
+
+class CheckStep(object):
+    """
+    A check of the testbed, compiled for a validator class: the
+    function that runs it (or, for composites, the names of its
+    mandatory parts) and the getters of its report fields.
+    """
+    __slots__ = ('test', 'name', 'func', 'parts', 'info',
+            'mandatory', 'final', 'per_uri', 'per_pubkey', 'parents')
+
+
+class CheckPlan(object):
+    """
+    The testbed compiled once for a validator class, so that
+    validate() runs the checks with no reflection at all.
+    The phases (cert, uri, pubkey and profile checks) are tuples
+    of CheckSteps, in execution order.
+    The spec hasPart edges are also linked, as the parents of each
+    step: the composites it is a mandatory part of. Once a composite
+    has a failed mandatory part, its outcome is settled, and the
+    checks below it are moot (see WebIDValidator.is_moot).
+    """
+    def __init__(self, testbed, cls):
+        self.steps = dict()
+        self.only_cert = self._compile(testbed, cls,
+                testbed.checks_only_cert)
+        self.only_uri = self._compile(testbed, cls,
+                testbed.checks_only_uri)
+        self.loop_pubkey = self._compile(testbed, cls,
+                testbed.checks_loop_pubkey)
+        self.loop_profile = self._compile(testbed, cls,
+                testbed.checks_loop_profile)
+        # the outcome of the validation is the one of this check.
+        self.final = testbed.tests[-1].name
+        self._link()
+        # profile checks that only sum up the pubkey checks.
+        pubkey_names = set([step.name for step in self.loop_pubkey])
+        self.audit = frozenset([step.name for step in self.loop_profile
+            if step.test.parts and
+            not set(step.test.parts).difference(pubkey_names)])
+
+    def _compile(self, testbed, cls, tests):
+        steps = []
+        for test in tests:
+            step = CheckStep()
+            step.test = test
+            step.name = test.name
+            step.mandatory = getattr(test, 'mandatory', False)
+            step.final = getattr(test, 'final', False)
+            step.func = None
+            step.parts = None
+            foreach = getattr(test, 'foreach', ())
+            step.per_uri = 'uri' in foreach or 'profile' in foreach
+            step.per_pubkey = 'pubkey' in foreach
+            step.parents = ()
+            if getattr(test, 'parts', False) and \
+                    not getattr(test, 'extra', False):
+                #A requirement test, or another testCase
+                # with subparts
+                #i.e., profileAllKeysWellFormed (foreach...)
+                parts = []
+                for name in test.parts:
+                    spec = getattr(testbed, "__%s" % name, None)
+                    if spec is not None and \
+                            getattr(spec, 'mandatory', True):
+                        parts.append(name)
+                step.parts = tuple(parts)
+            else:
+                #a simple, atomic TestCase
+                step.func = getattr(cls, "check_%s" % test.name, None)
+            info = []
+            for field in INFO_FIELDS:
+                info_field = getattr(test, field, False)
+                if info_field:
+                    getter = getattr(cls, "get_testinfo_%s" % info_field,
+                            None)
+                    if getter and callable(getter):
+                        info.append((field, getter))
+            step.info = tuple(info)
+            self.steps[step.name] = step
+            steps.append(step)
+        return tuple(steps)
+
+    def _link(self):
+        """
+        sets the parents of the steps that can be skipped: the ones
+        with no effects on later checks, that are not final, and
+        whose parents are all run in the same (or a broader) scope,
+        so their outcome is known when the step is about to run.
+        """
+        parents = dict()
+        for step in self.steps.values():
+            for name in step.parts or ():
+                parents.setdefault(name, []).append(step)
+        for step in self.steps.values():
+            if step.final or getattr(step.test, 'effects', False):
+                continue
+            linked = parents.get(step.name, ())
+            for parent in linked:
+                if (parent.per_uri and not step.per_uri) or \
+                        (parent.per_pubkey and not step.per_pubkey):
+                    break
+            else:
+                step.parents = tuple(linked)
+
+
+# the plans built by get_plan, by validator class.
+_plans = dict()
+_plans_lock = threading.Lock()
+
+
+def get_plan(cls):
+    """
+    returns the CheckPlan for a validator class,
+    compiling it the first time.
+    """
+    plan = _plans.get(cls, None)
+    if plan is None:
+        _plans_lock.acquire()
+        try:
+            plan = _plans.get(cls, None)
+            if plan is None:
+                plan = _plans[cls] = CheckPlan(get_testbed(), cls)
+        finally:
+            _plans_lock.release()
+    return plan
+
+
 class WebIDImplementationError(Exception):
     """
     Exception raised when some methods are missing from the spec.
@@ -69,8 +311,8 @@ class WebIDValidator(object):
     """
     Main validator object.
     Its entry point is the method "validate".
-    Has pointers to the tests passed, which in turn have
-    pointers to results.
+    Has a pointer to the (shared) testbed, and keeps the
+    results of the tests in self.results.
     """
     #XXX we could pass also a value for the RAISE_EXCEPTIONS value
     #XXX it will be useful for testing.
@@ -79,8 +321,13 @@ class WebIDValidator(object):
 
         self.certstr = None
         self.cert = None
-        self.URIS = set([])
+        #URIs in the SAN, in the order they appear in the cert.
+        self.URIS = tuple()
+        #loaders by uri (several uris can share the same loader,
+        #if they point to the same document) and by document.
         self.profiles = dict()
+        self.documents = dict()
+        self._fetch_errors = dict()
 
         self.webidclaims = defaultdict(set)
         self.webidkeys = defaultdict(set)
@@ -88,11 +335,9 @@ class WebIDValidator(object):
         self.validatedURI = None
         self.webid_name = None
 
-        self.testbed = WebIDChecks()
-
-        tb = self.testbed
-        for k in tb.testsdict.keys():
-            tb.testsdict[k] = self.get_spec(k)
+        self.testbed = get_testbed()
+        self.plan = get_plan(self.__class__)
+        self.results = ValidationResults()
 
         # And what about having a xslt transform ???
         # (for the report)
@@ -102,6 +347,9 @@ class WebIDValidator(object):
         certstr = kwargs.get('certstr', None)
         if certstr:
             self.certstr = certstr
+        #or an already built Cert (i.e., Cert.from_der,
+        #Cert.from_environ)
+        self.cert = kwargs.get('cert', None)
 
         #validation mode switch:
         #exhaustive will check _all_ the webid claims
@@ -111,6 +359,78 @@ class WebIDValidator(object):
 
         self.mode = kwargs.get('mode', 'firstmatch')
 
+        #report switch:
+        #with report=True (default) we keep a TestResult, with
+        #details, subject and pointer, for every check performed,
+        #as needed for the earl report.
+        #with report=False (auth-only) we only keep the outcome of
+        #the checks, which is all we need for the login path.
+
+        self.report = kwargs.get('report', True)
+
+        #requests session used to dereference the profiles.
+        #if None, the loaders use the process-wide shared session,
+        #so the keep-alive connections are reused across validations.
+        self.session = kwargs.get('session', None)
+
+        #the profiles for all the URIs in the cert are
+        #dereferenced concurrently, with this many threads at most.
+        #that is done up front, so in firstmatch mode the profiles
+        #after the matching URI are fetched too. with prefetch=False
+        #each profile is fetched when its URI is checked, in turn.
+        self.max_fetch_workers = kwargs.get('max_fetch_workers',
+                MAX_FETCH_WORKERS)
+        self.prefetch = kwargs.get('prefetch', True)
+
+        #an optional cache.ProfileCache. Returning users then get
+        #their profile (and the keys extracted from it) from the
+        #cache, or revalidated with a conditional GET.
+        self.profile_cache = kwargs.get('profile_cache', None)
+
+        #optional cache.NegativeCache and fetcher.CircuitBreaker,
+        #so we fail fast on profiles (and hosts) that keep failing.
+        #the reason of a failed fetch goes to fetch_failures and to
+        #the details of the profileGet result.
+        self.negative_cache = kwargs.get('negative_cache', None)
+        self.breaker = kwargs.get('breaker', None)
+        self.fetch_failures = dict()
+
+        #download limits for the profiles: a (connect, read) timeout
+        #tuple, max size in bytes and max seconds for the download.
+        #see fetcher.TIMEOUT, MAX_BYTES and MAX_TIME for the defaults.
+        self.fetch_limits = dict((k, kwargs[k]) for k in
+                ('timeout', 'max_bytes', 'max_time') if k in kwargs)
+
+        #opt-in streaming key extraction (RDF/XML and N-Triples),
+        #which does not build a graph for the profile. The report
+        #needs the graph anyway, so this only pays off with
+        #report=False.
+        self.streaming = kwargs.get('streaming', False)
+
+        #the report reserializes the profiles (as pretty-xml), which
+        #is slow; it's done when the report is written (see
+        #WebIDLoader.rawprofile), and an optional cache.LRUCache
+        #keeps them by content hash.
+        self.rawprofile_cache = kwargs.get('rawprofile_cache', None)
+
+        #an optional cache.ValidationCache. A returning cert then gets
+        #the outcome of its last validation, without being loaded nor
+        #its profiles fetched. As a hit has no per-check results, it's
+        #only used with report=False.
+        self.validation_cache = kwargs.get('validation_cache', None)
+        self.from_cache = False
+
+        #prune switch:
+        #skip the checks whose outcome cannot change any other
+        #(see CheckPlan), once a mandatory part of the composites
+        #above them has failed. The outcome of the validation is the
+        #same, but the skipped checks leave no results, so it is off
+        #by default for reports, and always off in strict mode (where
+        #the first failed check stops the validation).
+        #see results.run, results.skipped for the metrics.
+        self.prune = kwargs.get('prune', not self.report) and \
+                self.mode != "strict"
+
     @property
     def all_profiles(self):
         return self.profiles.values()
@@ -144,41 +464,19 @@ class WebIDValidator(object):
         the subpart tests.
         """
         #XXX re-check that this is a composite test
-        uri = kwargs.get("uri", None)
-        pubkey = kwargs.get("pubkey", None)
-
-        #print '----------checking composite %s' % test.name
-
-        spec = self.get_spec(test.name)
-        methods = [self.get_spec(name) for name in spec.parts if \
-                getattr(self.get_spec(name), 'mandatory', True)]
-
-        #all_methods = [self.get_spec(name) for name in spec.parts]
-        #print 'all_methods', all_methods
-
-        results = []
-        for m in methods:
-            for r in m.results:
-                if uri and pubkey:
-                    #print 'uri + pubkey'
-                    if r.pubkey == pubkey and r.uri == uri:
-                        results.append(r)
-
-                if uri and not pubkey:
-                    #print 'uri'
-                    if r.uri == uri:
-                        results.append(r)
-
-                if not uri and not pubkey:
-                    #print 'nor uri nor pk'
-                    results.append(r)
-
-        if results:
-            individual_tests = [r.passed for r in results]
-        else:
-            individual_tests = [False]
-        #print individual_tests
-        return all(individual_tests)
+        parts = self.plan.steps[test.name].parts or ()
+        return self._check_parts(parts, kwargs.get("uri", None),
+                kwargs.get("pubkey", None))
+
+    def _check_parts(self, parts, uri=None, pubkey=None):
+        total = 0
+        for name in parts:
+            count, failed = self.results.count(name, uri, pubkey)
+            if failed:
+                return False
+            total += count
+        # no results at all means we could not check the parts.
+        return total > 0
 
     # methods to get pointers / subjects on test results
 
@@ -245,88 +543,151 @@ class WebIDValidator(object):
     def get_testinfo_rstatus(self, **kwargs):
         uri = kwargs.get('uri', None)
         widprofile = self.profiles.get(uri, None)
+        if widprofile and widprofile.reason:
+            return widprofile.reason
         if widprofile and hasattr(widprofile, 'rstatus_code'):
             return "response status code: %s" % widprofile.rstatus_code
         else:
             return None
 
-    def add_test_info(self, field=None, result=None, spec=None, **kwargs):
+    def do_check(self, test, **kwargs):
         """
-        checks if the spec class has some details field,
-        executes that method if it exists, and add a new
-        attr to test with the returned value.
+        performs a given check.
         """
-        kwargs['result'] = result
-        info_field = getattr(spec, field, False)
-        if info_field:
-            info_meth = getattr(self, "get_testinfo_%s" % info_field, None)
-            if info_meth and callable(info_meth):
-                info = info_meth(**kwargs)
-                if info:
-                    setattr(result, field, info)
+        return self.run_step(self.plan.steps[test.name],
+                kwargs.get('uri', None), kwargs.get('pubkey', None))
 
-        #we write uri / pubkey also in results
-        #so we have it accessible for later.
-        for k, v in kwargs.items():
-            setattr(result, k, v)
-
-    def get_method_name(self, test):
+    def is_moot(self, step, uri=None, pubkey=None):
         """
-        returns the proper method name for a given test.
-        it's the same as the class spec, but replacing __
-        by check prefixes.
+        returns True if the outcome of a step does not matter any
+        more: all the composites it is a part of are already failed
+        (or moot themselves).
         """
-        return test._getTestMethodName().replace("__", "check_")
+        if not step.parents:
+            return False
+        for parent in step.parents:
+            puri = uri if parent.per_uri else None
+            ppubkey = pubkey if parent.per_pubkey else None
+            failed = False
+            for name in parent.parts:
+                if self.results.count(name, puri, ppubkey)[1]:
+                    failed = True
+                    break
+            if not failed and not self.is_moot(parent, uri, pubkey):
+                return False
+        return True
 
-    def do_check(self, test, **kwargs):
+    def run_step(self, step, uri=None, pubkey=None):
         """
-        performs a given check.
+        performs a check of the plan (a CheckStep).
+        returns None if it was skipped (see prune).
         """
-        #print "doing check %s" % test.name
-        passed = False
-        uri = kwargs.get('uri', None)
-        pubkey = kwargs.get('pubkey', None)
+        if self.prune and self.results.failed and \
+                self.is_moot(step, uri, pubkey):
+            logger.debug('skipping moot check %s' % step.name)
+            self.results.skip(step.name)
+            return None
 
-        spec = self.get_spec(test.name)
-        methodname = self.get_method_name(test)
+        passed = self._run_check(step, uri, pubkey)
 
-        has_parts = getattr(spec, 'parts', False)
-        has_extra = getattr(spec, 'extra', False)
+        if not self.report:
+            self.results.add(step.name, passed, uri=uri, pubkey=pubkey)
+            self.post_check_passed(step.name, passed, test=step.test, uri=uri)
+            return passed
 
-        if (has_parts and not has_extra):
-            #A requirement test, or another testCase
-            # with subparts
-            #i.e., profileAllKeysWellFormed (foreach...)
-            logger.debug('do_check: composite %s' % test)
-            passed = self.check_composite(test, **kwargs)
-        else:
-            #a simple, atomic TestCase
-            testmethod = self.get_method(methodname)
-            if not testmethod:
-                raise WebIDImplementationError(
-                "Validator tried a method which is not Implemented yet: %s" % \
-                    (methodname))
-            passed = testmethod(**kwargs)
-
-        #XXX need a switch for disabling test results #######
-        #it takes too long!
-        test_result = TestResult(passed=passed)
+        #we write uri / pubkey also in results
+        #so we have it accessible for later.
+        test_result = TestResult(passed=passed, uri=uri, pubkey=pubkey)
 
         # we write details on test results (collateral effect)
         # to be able to generate report
+        for field, getter in step.info:
+            info = getter(self, uri=uri, pubkey=pubkey, result=test_result)
+            if info:
+                setattr(test_result, field, info)
 
-        for info_field in ("details", "subject", "pointer"):
-            self.add_test_info(info_field,
-                    result=test_result, spec=spec,
-                    uri=uri, pubkey=pubkey)
-
-        test.results = test.results + (test_result,)
+        self.results.add(step.name, passed, uri=uri, pubkey=pubkey,
+                result=test_result)
 
         ######################################################
 
-        self.post_check_passed(methodname, passed, test=test, uri=uri)
+        self.post_check_passed(step.name, passed, test=step.test, uri=uri)
         return passed
 
+    def _run_check(self, step, uri, pubkey):
+        """
+        returns the outcome of a step: of its parts, for a composite
+        check, or of its method.
+        """
+        if step.parts is not None:
+            return self._check_parts(step.parts, uri, pubkey)
+        if step.func is None:
+            raise WebIDImplementationError(
+                "Validator tried a method which is not Implemented "
+                "yet: %s" % step.name)
+        return step.func(self, uri=uri, pubkey=pubkey)
+
+    def run_pubkey_stage(self, uri):
+        """
+        runs the pubkey checks for all the keys of a profile at once,
+        one check (column) at a time, and keeps the outcomes in
+        results.columns.
+        The cert key is looked up first: in firstmatch mode, with
+        prune, if it's there we are going to stop at this uri, so
+        auditing its keys does not matter, and we skip it.
+        returns False if the keys were not audited.
+        """
+        keys = tuple(self.webidkeys[uri])
+        if not keys:
+            return True
+        plan = self.plan
+        if self.prune and self.mode == "firstmatch" and \
+                self.cert is not None and \
+                self.cert.pubkey in self.webidkeys[uri]:
+            logger.debug('cert key found for uri %s, not auditing %s keys'
+                    % (uri, len(keys)))
+            for step in plan.loop_pubkey:
+                self.results.skip(step.name, len(keys))
+            return False
+        columns = dict()
+        for step in plan.loop_pubkey:
+            columns[step.name] = self.run_column(step, uri, keys)
+        self.results.columns[uri] = (keys, columns)
+        return True
+
+    def run_column(self, step, uri, keys):
+        """
+        performs a check of the plan for each of the given keys.
+        returns the list of outcomes.
+        """
+        if self.report or self.mode == "strict" or step.final or \
+                WEBID_RAISE_EXCEPTIONS:
+            return [self.run_step(step, uri, pubkey) for pubkey in keys]
+
+        # auth-only: no TestResults and nothing to raise, so we
+        # only record the outcomes, and log once per column.
+        results = self.results
+        add = results.add
+        name = step.name
+        run_check = self._run_check
+        outcomes = []
+        failed = 0
+        for pubkey in keys:
+            if self.prune and results.failed and \
+                    self.is_moot(step, uri, pubkey):
+                results.skip(name)
+                outcomes.append(None)
+                continue
+            passed = run_check(step, uri, pubkey)
+            add(name, passed, uri=uri, pubkey=pubkey)
+            if not passed:
+                failed += 1
+            outcomes.append(passed)
+        if failed:
+            logger.warning("%s failed for %s of %s keys" % (name, failed,
+                len(keys)))
+        return outcomes
+
     def post_check_passed(self, methodname, passed, test=None, uri=None):
         """
         according to configuration parameter, either log the test
@@ -335,7 +696,8 @@ class WebIDValidator(object):
         if passed is True:
             logger.info("%s passed!" % methodname)
             final = getattr(test, 'final', False)
-            if final and uri is not None:
+            # the first URI that matched, in SAN order
+            if final and uri is not None and self.validatedURI is None:
                 self.validatedURI = uri
             if final and self.mode == "firstmatch":
                 raise WebIDAuthMatched()
@@ -364,22 +726,42 @@ class WebIDValidator(object):
         entry point for validation
         public method that calls the rest
         """
+        self.results = ValidationResults()
+        self.from_cache = False
+        self.validatedURI = None
+        fingerprint = None
+        if self.validation_cache is not None and not self.report:
+            if self.cert is not None:
+                fingerprint = self.cert.fingerprint
+            elif self.certstr:
+                fingerprint = get_fingerprint(self.certstr)
+            outcome = self.validation_cache.lookup(fingerprint)
+            if outcome is not None:
+                logger.debug('using cached validation for cert %s'
+                        % fingerprint)
+                self.from_cache = True
+                validated, self.validatedURI = outcome
+                return validated, self
+        plan = self.plan
         try:
-            for test in self.testbed.checks_only_cert:
-                self.do_check(test)
+            for step in plan.only_cert:
+                self.run_step(step)
+
+            self._fetch_profiles()
 
             for uri in self.URIS:
                 #only uris loop
-                for test in self.testbed.checks_only_uri:
-                    self.do_check(test=test, uri=uri)
+                for step in plan.only_uri:
+                    self.run_step(step, uri)
 
                 #only pks loop
-                for pubkey in self.webidkeys[uri]:
-                    for test in self.testbed.checks_loop_pubkey:
-                        self.do_check(test=test, uri=uri, pubkey=pubkey)
+                audited = self.run_pubkey_stage(uri)
 
-                for test in self.testbed.checks_loop_profile:
-                    self.do_check(test=test, uri=uri)
+                for step in plan.loop_profile:
+                    if not audited and step.name in plan.audit:
+                        self.results.skip(step.name)
+                        continue
+                    self.run_step(step, uri)
 
         except WebIDAuthMatched:
             validated = True
@@ -387,19 +769,26 @@ class WebIDValidator(object):
         except WebIDAuthStrictFailed:
             validated = False
 
-        #XXX fix this
-        #At least one of the final reqs is done...
-        if not hasattr(self.testbed.tests[-1], 'results'):
-            #print 'no results on last test... :('
-            validated = False
-        else:
-            if len(self.testbed.tests[-1].results) == 0:
-                validated = False
-            else:
-                validated = self.testbed.tests[-1].results[-1].passed
+        #At least one of the final reqs is done, for any URI
+        #(not only the last one checked).
+        total, failed = self.results.count(plan.final)
+        validated = total > failed
+
+        if fingerprint is not None:
+            ttl = self.cert.seconds_to_expire() if self.cert else None
+            self.validation_cache.store(fingerprint, validated,
+                    uri=self.validatedURI, ttl=ttl)
 
         return validated, self
 
+    def get_results(self, test):
+        """
+        returns the results of the last validation
+        for a given test (or test name).
+        """
+        name = getattr(test, 'name', test)
+        return self.results.get(name)
+
     @property
     def all_webidclaims(self):
         return tuple([x for x in chain(*self.webidclaims.values())])
@@ -413,6 +802,8 @@ class WebIDValidator(object):
     #
 
     def check_certificateProvided(self, **kwargs):
+        if self.cert is not None:
+            return True
         if not getattr(self, 'certstr', None):
             return False
         try:
@@ -437,8 +828,11 @@ class WebIDValidator(object):
         altName = self.cert.get_subjectAltName()
         if not altName:
             return False
-        uris = set(re.findall('URI:([^, ]+)', altName))
-        self.URIS = uris
+        uris = []
+        for uri in re.findall('URI:([^, ]+)', altName):
+            if uri not in uris:
+                uris.append(uri)
+        self.URIS = tuple(uris)
         self.validatedURI = None
         # return False if no URIS???
         return True if altName else False
@@ -477,10 +871,21 @@ class WebIDValidator(object):
     def check_profileGet(self, **kwargs):
         try:
             uri = kwargs.get('uri', None)
-            webidprofile = WebIDLoader(uri)
-            webidprofile.get()
-            self.profiles[uri] = webidprofile
+            webidprofile = self.profiles.get(uri, None)
+            if webidprofile is None:
+                document = urldefrag(uri)[0]
+                webidprofile = self.documents.get(document, None)
+                if webidprofile is None:
+                    webidprofile = self._get_loader(document)
+                    webidprofile.load()
+                    self.documents[document] = webidprofile
+                self.profiles[uri] = webidprofile
+            error = self._fetch_errors.pop(uri, None)
+            if error:
+                raise error[0], error[1], error[2]
             if not getattr(webidprofile, 'ok', None):
+                if webidprofile.reason:
+                    self.fetch_failures[uri] = webidprofile.reason
                 return False
         except:
             raise  # DEBUG
@@ -494,8 +899,7 @@ class WebIDValidator(object):
             webidprofile = self.profiles[uri]
             if not getattr(webidprofile, 'ok', None):
                 return False
-            webidprofile.parse()
-            self._extract_webid_credentials(webidprofile.graph, uri)
+            self._extract_webid_credentials(webidprofile, uri)
             return True
         except:
             raise
@@ -579,24 +983,55 @@ class WebIDValidator(object):
     #########################################
     # begin private methods
 
-    def _extract_webid_credentials(self, graph, uri):
+    def _get_loader(self, uri):
+        """
+        returns a new WebIDLoader for uri, with our fetch settings.
+        """
+        return WebIDLoader(uri, session=self.session,
+                cache=self.profile_cache,
+                negative_cache=self.negative_cache,
+                breaker=self.breaker,
+                streaming=self.streaming,
+                rawprofile_cache=self.rawprofile_cache,
+                **self.fetch_limits)
+
+    def _fetch_profiles(self):
+        """
+        dereferences the profiles of all the URIs in the cert
+        concurrently. URIs that differ only by fragment share the
+        same document, which is fetched (and parsed) only once.
+        check_profileGet then picks the loaders (and any exception
+        raised while fetching) for each URI, in the same order as
+        before. Without prefetch, it fetches them itself.
+        """
+        self.profiles = dict()
+        self.documents = dict()
+        self._fetch_errors = dict()
+        self.fetch_failures = dict()
+        if not self.prefetch:
+            return
+        uris_by_document = dict()
+        loaders = []
+        for uri in self.URIS:
+            document = urldefrag(uri)[0]
+            if document not in self.documents:
+                loader = self._get_loader(document)
+                self.documents[document] = loader
+                loaders.append(loader)
+            uris_by_document.setdefault(document, []).append(uri)
+            self.profiles[uri] = self.documents[document]
+        errors = get_all(loaders, max_workers=self.max_fetch_workers)
+        for loader, error in zip(loaders, errors):
+            if error:
+                for uri in uris_by_document[loader.uri]:
+                    self._fetch_errors[uri] = error
+
+    def _extract_webid_credentials(self, webidprofile, uri):
         logger.info('loading webid credentials for uri %s' % uri)
-        #XXX this GRAPH also should be a dict by uri
-        results = graph.query(constants.WEBID_SPARQL_SIMPLE)
-        for result in results:
-            mod, exp = result
-            #TODO refactor all replaces into
-            #a single regexp
-            mod_lit = unicode(mod).replace(' ', '').\
-                    replace('\n', '').\
-                    replace('"', '').\
-                    replace('\t', '').\
-                    encode('ascii', 'ignore').lower()
-            exp_int = int(unicode(exp))
-            pubkey = PublicKey(mod=mod_lit, exp=exp_int)
-            webidClaim = WebIDClaim(uri, pubkey)
-
-            self.webidclaims[uri].add(webidClaim)
+        for pubkey in webidprofile.get_credentials(uri):
+            if self.report:
+                webidClaim = WebIDClaim(uri, pubkey)
+                self.webidclaims[uri].add(webidClaim)
             self.webidkeys[uri].add(pubkey)
 
     def _check_credentials(self, **kwargs):
@@ -628,7 +1063,11 @@ class WebIDValidator(object):
         """
         if not uri:
             return None
-        graph = self.profiles[uri].graph
+        webidprofile = self.profiles[uri]
+        if webidprofile.graph is None and webidprofile.rcontent:
+            # we got the keys from the cache, without parsing
+            webidprofile.parse()
+        graph = webidprofile.graph
         if graph:
             webid_name = {}
             if sparql_query:
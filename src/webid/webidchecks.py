@@ -1,9 +1,33 @@
 import uuid
 import inspect
+import threading
 from itertools import tee, islice, chain, izip
 
 from earl import Parser
 
+# the testbed built by get_testbed, shared by all validators
+# in this process.
+_testbed = None
+_testbed_lock = threading.Lock()
+
+
+def get_testbed():
+    """
+    returns the WebIDChecks testbed, building it the first time.
+    The testbed only holds (immutable) spec metadata, so it is
+    safe to share it among validators and threads; results are
+    kept by each validator.
+    """
+    global _testbed
+    if _testbed is None:
+        _testbed_lock.acquire()
+        try:
+            if _testbed is None:
+                _testbed = WebIDChecks()
+        finally:
+            _testbed_lock.release()
+    return _testbed
+
 
 class WebIDChecks(object):
     order = 0
@@ -16,12 +40,8 @@ class WebIDChecks(object):
         self.title = None
         self.description = None
         self.notes = None
-        self.results = tuple()
         self.mandatory = True
-        #XXX FIXME validatedURI should be
-        #set properly when done.
-        self.validatedURI = None
-        #change to tuple
+        #frozen to a tuple once the earl tests are read.
         self.parts = list()
         self.tests = list()
         self.earltests = set([])
@@ -49,7 +69,8 @@ class WebIDChecks(object):
                             'mandatory',
                             getattr(subclass, 'mandatory'))
             self.getEarlTests()
-            self.tests = self._getOrderedTests()
+            self.tests = tuple(self._getOrderedTests())
+            self._freeze()
 
     def __repr__(self):
         if getattr(self, 'requirement', False):
@@ -103,6 +124,32 @@ class WebIDChecks(object):
         nexts = chain(islice(nexts, 1, None), [None])
         return izip(prevs, items, nexts)
 
+    def _freeze(self):
+        """
+        fills testsdict with the spec instances, and turns the
+        mutable containers into immutable ones, so the testbed
+        can be shared.
+        """
+        for test in self.testsdict.keys():
+            spec = getattr(self, "__%s" % test, None)
+            self.testsdict[test] = spec
+            if spec is not None:
+                spec.parts = tuple(spec.parts)
+        self.earltests = frozenset(self.earltests)
+        # the blocks of checks, split once.
+        self._checks_only_cert = tuple([x for x in self.tests
+            if not hasattr(x, 'foreach')])
+        self._checks_only_uri = tuple([x for x in self.tests
+            if hasattr(x, 'foreach')
+            and 'uri' in x.foreach
+            and 'pubkey' not in x.foreach])
+        self._checks_loop_pubkey = tuple([x for x in self.tests
+            if hasattr(x, 'foreach')
+            and 'pubkey' in x.foreach])
+        self._checks_loop_profile = tuple([x for x in self.tests
+            if hasattr(x, 'foreach')
+            and 'profile' in x.foreach])
+
     def getEarlTests(self):
         """
         get a EarlParser object
@@ -155,18 +202,14 @@ class WebIDChecks(object):
         """
         returns only checks that deal with certificate
         """
-        return [x for x in self.tests \
-            if not hasattr(x, 'foreach')]
+        return self._checks_only_cert
 
     @property
     def checks_only_uri(self):
         """
         returns the block of checks that deal with uri
         """
-        return [x for x in self.tests \
-                if hasattr(x, 'foreach') \
-                and 'uri' in x.foreach \
-                and 'pubkey' not in x.foreach]
+        return self._checks_only_uri
 
     @property
     def checks_loop_pubkey(self):
@@ -174,9 +217,7 @@ class WebIDChecks(object):
         returns the block of checks that deal with pubkeys
         in a given uri
         """
-        return [x for x in self.tests \
-                if hasattr(x, 'foreach') \
-                and 'pubkey' in x.foreach]
+        return self._checks_loop_pubkey
 
     @property
     def checks_loop_profile(self):
@@ -184,22 +225,17 @@ class WebIDChecks(object):
         returns the block of checks that deal with pubkeys
         in a given uri
         """
-        return [x for x in self.tests \
-                if hasattr(x, 'foreach') \
-                and 'profile' in x.foreach]
-
-    def get_results(uri=None, pk=None):
-        """
-        stub. should return filtered results
-        from the tuple
-        """
-        pass
+        return self._checks_loop_profile
 
 # certificate tests
 
 
+# effects = True marks the checks that set state used by
+# later checks (the cert, the URIs, the profiles, the keys),
+# so the validator never skips them (see CheckPlan).
 class __certificateProvided(WebIDChecks):
     order = 1
+    effects = True
     error = u"We did not receive a user certificate. It could be that user has\
 not sent one, or a timeout, or a server misconfiguration. Please check."
     pointer = "cert"
@@ -207,6 +243,7 @@ not sent one, or a timeout, or a server misconfiguration. Please check."
 
 class __certificateProvidedSAN(WebIDChecks):
     order = 2
+    effects = True
     subject = "cert"
     pointer = "subjectAltName"
     details = "subjectAltName"
@@ -220,6 +257,7 @@ class __certificateDateOk(WebIDChecks):
 
 class __certificatePubkeyRecognised(WebIDChecks):
     order = 4
+    effects = True
     subject = "cert"
     pointer = "cert_pubkey"
 
@@ -238,6 +276,7 @@ class __certificateOk(WebIDChecks):
 # profile tests
 class __profileGet(WebIDChecks):
     order = 7
+    effects = True
     subject = "profile"
     details = "rstatus"
     foreach = ("uri",)
@@ -245,6 +284,7 @@ class __profileGet(WebIDChecks):
 
 class __profileWellFormed(WebIDChecks):
     order = 8
+    effects = True
     subject = "profile"
     foreach = ("uri",)
 
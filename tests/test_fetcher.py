@@ -0,0 +1,191 @@
+"""
+tests for the profile loader, against a local http server.
+"""
+import BaseHTTPServer
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import requests
+
+from webid.fetcher import CircuitBreaker, Watchdog, WebIDLoader, get_all, \
+        get_redirect, new_session
+
+PROFILE = """@prefix cert: <http://www.w3.org/ns/auth/cert#> .
+<#me> cert:key [ cert:exponent 65537 ] .
+"""
+BROKEN_PROFILE = "<#me> cert:key [ this is not turtle"
+
+
+class ProfileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    serves PROFILE at /fast, and at /slow one byte every
+    half a second; BROKEN_PROFILE at /broken, after half a second.
+    /old is moved permanently to /new (on 127.0.0.1), which serves
+    PROFILE, or fails with server.new_status if it's set.
+    """
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.cookies.append(self.headers.get('Cookie', None))
+        if self.path == '/old':
+            self.send_response(301)
+            self.send_header('Location', 'http://127.0.0.1:%s/new' % (
+                self.server.server_port))
+            self.end_headers()
+            return
+        if self.path == '/new' and self.server.new_status:
+            self.send_response(self.server.new_status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        content = PROFILE
+        if self.path == '/broken':
+            time.sleep(0.5)
+            content = BROKEN_PROFILE
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/turtle')
+        self.send_header('Set-Cookie', 'visitor=%s; Path=/' % len(
+            self.server.requests))
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.path == '/slow':
+            for byte in PROFILE:
+                self.wfile.write(byte)
+                self.wfile.flush()
+                time.sleep(0.5)
+        else:
+            self.wfile.write(content)
+
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            # we have been hung up on
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                ProfileHandler)
+        self.server.requests = []
+        self.server.cookies = []
+        self.server.new_status = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.base = 'http://127.0.0.1:%s' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def loader(self, path, **kwargs):
+        return WebIDLoader(self.base + path, **kwargs)
+
+
+class DownloadLimitsTest(ServerTestCase):
+
+    def loader(self, path, **kwargs):
+        return WebIDLoader(self.base + path, session=requests.Session(),
+                **kwargs)
+
+    def test_fast_profile(self):
+        loader = self.loader('/fast', max_time=1, timeout=(2, 2))
+        self.assertTrue(loader.get())
+        self.assertEqual(loader.rcontent, PROFILE)
+
+    def test_slow_profile_is_aborted_on_time(self):
+        loader = self.loader('/slow', max_time=1, timeout=(2, 2))
+        start = time.time()
+        self.assertFalse(loader.get())
+        self.assertTrue(time.time() - start < 2.5)
+        self.assertTrue('download aborted' in loader.reason)
+
+
+class WatchdogTest(unittest.TestCase):
+
+    def test_calls_in_order_unless_cancelled(self):
+        watchdog = Watchdog()
+        calls = []
+        watchdog.watch(0.2, lambda: calls.append('late'))
+        cancelled = watchdog.watch(0.1, lambda: calls.append('cancelled'))
+        watchdog.watch(0.1, lambda: calls.append('early'))
+        watchdog.cancel(cancelled)
+        time.sleep(0.5)
+        self.assertEqual(calls, ['early', 'late'])
+
+
+class SingleFlightTest(ServerTestCase):
+
+    def test_concurrent_loads_share_the_parse_error(self):
+        loaders = [self.loader('/broken#me'), self.loader('/broken#you')]
+        self.assertEqual(get_all(loaders), [None, None])
+        self.assertEqual(self.server.requests, ['/broken'])
+        self.assertTrue(loaders[0].parse_error is not None)
+        self.assertTrue(loaders[1].parse_error is loaders[0].parse_error)
+        for loader in loaders:
+            self.assertRaises(Exception, loader.get_credentials)
+
+    def test_other_settings_do_not_share(self):
+        loaders = [self.loader('/broken#me'),
+                self.loader('/broken#you', max_bytes=1024)]
+        get_all(loaders)
+        self.assertEqual(self.server.requests, ['/broken', '/broken'])
+
+
+class SessionTest(ServerTestCase):
+
+    def test_session_keeps_no_cookies(self):
+        session = new_session()
+        for path in ('/fast#me', '/fast#you'):
+            loader = self.loader(path, session=session)
+            self.assertTrue(loader.get())
+        self.assertEqual(self.server.cookies, [None, None])
+        self.assertEqual(len(session.cookies), 0)
+
+
+class RedirectTest(ServerTestCase):
+
+    def setUp(self):
+        ServerTestCase.setUp(self)
+        # another host name for the server, so the redirect
+        # changes hosts.
+        self.old = 'http://localhost:%s/old' % self.server.server_port
+        self.new_host = '127.0.0.1:%s' % self.server.server_port
+
+    def test_redirect_is_forgotten_when_target_fails(self):
+        self.assertTrue(WebIDLoader(self.old).get())
+        self.assertTrue(get_redirect(self.old).endswith('/new'))
+        self.server.new_status = 404
+        self.assertFalse(WebIDLoader(self.old).get())
+        self.assertEqual(self.server.requests, ['/old', '/new', '/new'])
+        self.assertEqual(get_redirect(self.old), None)
+
+    def test_breaker_records_the_requested_host(self):
+        breaker = CircuitBreaker()
+        self.assertTrue(WebIDLoader(self.old, breaker=breaker).get())
+        self.server.new_status = 503
+        self.assertFalse(WebIDLoader(self.old, breaker=breaker).get())
+        self.assertEqual(breaker.failures(self.new_host), 1)
+        self.assertEqual(breaker.failures(
+            'localhost:%s' % self.server.server_port), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()